@@ -0,0 +1,78 @@
+import time
+import argparse
+import tempfile
+import numpy as np
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+from torchvision import transforms
+from preprocessing import ImagePreprocessor
+from benchmarks.synthetic import make_images, summarize
+
+# The pipeline trainer.py and model_server.py used before preprocessing.py
+baseline_transform = transforms.Compose([
+    transforms.Lambda(lambda img: img.convert("RGB")),
+    transforms.Resize(size=(256, 256)),
+    transforms.ToTensor()
+])
+
+# Per-image latencies in seconds, each image decoded from its encoded bytes
+def time_pipeline(pipeline, contents: list[bytes], repeats: int) -> list[float]:
+    pipeline(contents[0]) # Warm-up
+
+    timings = []
+    for _ in range(repeats):
+        for data in contents:
+            start = time.perf_counter()
+            pipeline(data)
+            timings.append(time.perf_counter() - start)
+
+    return timings
+
+def run(count: int = 20, width: int = 1920, height: int = 1080, repeats: int = 3) -> dict:
+    preprocessor = ImagePreprocessor(size=256)
+
+    with tempfile.TemporaryDirectory() as directory:
+        contents = [path.read_bytes() for path in make_images(Path(directory), list(range(count)), width, height)]
+
+    pipelines = {
+        'baseline': lambda data: baseline_transform(Image.open(BytesIO(data))),
+        'draft_float': preprocessor,
+        'draft_uint8': preprocessor.to_uint8
+    }
+
+    results = {}
+    for name, pipeline in pipelines.items():
+        results[name] = summarize(time_pipeline(pipeline, contents, repeats))
+        results[name]['images_per_sec'] = 1000 / results[name]['mean_ms']
+
+    # How far the reduced-scale decode lands from the full decode, in
+    #   [0, 1] pixel units
+    differences = np.concatenate([
+        (preprocessor(data) - baseline_transform(Image.open(BytesIO(data)))).abs().flatten().numpy()
+        for data in contents
+    ])
+    results['difference'] = {'mean': float(differences.mean()), 'max': float(differences.max())}
+    results['speedup'] = results['baseline']['p50_ms'] / results['draft_uint8']['p50_ms']
+    results['image_size'] = [width, height]
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-image decode latency of preprocessing.py against the torchvision pipeline it replaced')
+    parser.add_argument('-n', '--count', type=int, help='Distinct synthetic screenshots', default=20)
+    parser.add_argument('-r', '--repeats', type=int, help='Passes over the screenshots', default=3)
+    parser.add_argument('--width', type=int, help='Screenshot width', default=1920)
+    parser.add_argument('--height', type=int, help='Screenshot height', default=1080)
+    args = parser.parse_args()
+
+    results = run(args.count, args.width, args.height, args.repeats)
+
+    for name in ['baseline', 'draft_float', 'draft_uint8']:
+        result = results[name]
+        print(f'{name:12} p50 {result["p50_ms"]:6.2f} ms | p99 {result["p99_ms"]:6.2f} ms | {result["images_per_sec"]:7.1f} images/sec')
+    print(f'Speedup (p50): {results["speedup"]:.1f}x')
+    print(f'Pixel difference: mean {results["difference"]["mean"]:.4f}, max {results["difference"]["max"]:.4f}')
+
+if __name__ == "__main__":
+    main()
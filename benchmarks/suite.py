@@ -0,0 +1,386 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+import requests
+import torch
+import numpy as np
+import split
+import scraper
+import inference
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import DataLoader
+from model import MultiLabelClassifier
+from dataset import CustomDataset
+from preprocess import build_shards
+from preprocessing import ImagePreprocessor
+from fetcher import Fetcher, ResponseCache
+from tag_db import TagWriter, TABLE
+from steam_stub import start_server
+from benchmarks.synthetic import make_dataset, make_images, make_tag_db, summarize
+
+BENCHMARKS = ['dataset', 'split', 'training', 'get_pred', 'startup', 'predict', 'scraper']
+REPO_PATH = Path(__file__).parent.parent
+
+def log(message: str) -> None:
+    print(message, file=sys.stderr, flush=True)
+
+# Module output (progress prints of split.py and the scraper) would otherwise
+#   mix with the JSON on stdout
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=REPO_PATH).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def make_model() -> MultiLabelClassifier:
+    torch.manual_seed(0)
+    return MultiLabelClassifier(in_count=3, hidden_count=128, out_count=len(inference.labels))
+
+def save_model(work_dir: Path) -> Path:
+    model_path = work_dir/'benchmark.pt'
+    if not model_path.exists():
+        torch.save(make_model().state_dict(), model_path)
+    return model_path
+
+# Polls /ready until the server has loaded and warmed up its model
+def wait_until_ready(url: str, timeout: float = 300) -> dict:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            response = requests.get(f'{url}/ready', timeout=1)
+            if response.status_code == 200:
+                return response.json()
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f'{url} was not ready after {timeout}s')
+
+# CustomDataset item latency and DataLoader epoch throughput, decoding JPEGs
+#   and reading shards
+def bench_dataset(work_dir: Path, rows: int, batch_size: int, workers: int) -> dict:
+    data_path = work_dir/'dataset'
+    log(f'dataset: generating {rows} screenshots')
+    make_dataset(data_path, rows)
+
+    start = time.perf_counter()
+    with quiet():
+        shard_path = build_shards(data_path, 'tag_info.db', TABLE, 256, num_workers=workers)
+    results = {'rows': rows, 'workers': workers, 'shard_build_sec': time.perf_counter() - start}
+
+    for mode, options in [('jpeg', {'transform': ImagePreprocessor(256).to_uint8}), ('shards', {'shard_path': shard_path})]:
+        dataset = CustomDataset(data_path=data_path, db_file='tag_info.db', table=TABLE, **options)
+
+        timings = []
+        for index in np.random.default_rng(0).permutation(len(dataset)):
+            start = time.perf_counter()
+            dataset[int(index)]
+            timings.append(time.perf_counter() - start)
+
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=workers)
+        start = time.perf_counter()
+        samples = sum(len(inputs) for inputs, _ in loader)
+        epoch_time = time.perf_counter() - start
+
+        results[mode] = {'item': summarize(timings), 'epoch_samples_per_sec': samples / epoch_time}
+
+    return results
+
+# split.main on games tables of increasing size: a first split, then a rerun
+#   with nothing new to assign
+def bench_split(work_dir: Path, row_counts: list[int]) -> dict:
+    results = {}
+
+    for rows in row_counts:
+        for mode in ['hash', 'stratified']:
+            log(f'split: {rows} rows, {mode}')
+            db_path = work_dir/f'split-{rows}-{mode}.db'
+            make_tag_db(db_path, list(range(1000, 1000 + rows)))
+
+            timings = {}
+            for run in ['first', 'rerun']:
+                split.DB_PATH = str(db_path)
+                sys.argv = ['split.py'] + (['--stratify'] if mode == 'stratified' else [])
+
+                start = time.perf_counter()
+                with quiet():
+                    split.main()
+                timings[f'{run}_sec'] = time.perf_counter() - start
+
+            results[f'{rows}/{mode}'] = {'rows': rows, 'mode': mode, **timings, 'rows_per_sec': rows / timings['first_sec']}
+
+    return results
+
+# Optimizer steps on random uint8 batches, as the trainer sees them from shards
+def bench_training(batch_size: int, steps: int, amp: bool) -> dict:
+    model = make_model()
+    loss_fn = torch.nn.BCEWithLogitsLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    inputs = torch.randint(0, 256, (batch_size, 3, 256, 256), dtype=torch.uint8)
+    labels = (torch.rand(batch_size, len(inference.labels)) < 0.25).float()
+
+    results = {'batch_size': batch_size, 'steps': steps, 'threads': torch.get_num_threads()}
+
+    for precision in ['fp32', 'bf16'] if amp else ['fp32']:
+        log(f'training: {precision}')
+        autocast = torch.autocast('cpu', dtype=torch.bfloat16) if precision == 'bf16' else contextlib.nullcontext()
+        model.train()
+
+        timings = []
+        for step in range(steps + 1): # The first step is warm-up
+            start = time.perf_counter()
+            with autocast:
+                loss = loss_fn(model(inputs.float().div_(255)).float(), labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if step > 0:
+                timings.append(time.perf_counter() - start)
+
+        results[precision] = {'step': summarize(timings), 'samples_per_sec': batch_size * steps / sum(timings)}
+
+    return results
+
+# inference.get_pred on one screenshot at a time, decoding included
+def bench_get_pred(work_dir: Path, calls: int) -> dict:
+    model = make_model().eval()
+    contents = [path.read_bytes() for path in make_images(work_dir/'get_pred', list(range(min(calls, 10))))]
+    preprocessor = ImagePreprocessor(256)
+
+    inference.get_pred(model, preprocessor.open(contents[0]), 'cpu') # Warm-up
+
+    timings = []
+    for i in range(calls):
+        start = time.perf_counter()
+        inference.get_pred(model, preprocessor.open(contents[i % len(contents)]), 'cpu')
+        timings.append(time.perf_counter() - start)
+
+    return {'latency': summarize(timings), 'images_per_sec': calls / sum(timings)}
+
+# A fresh server process from spawn to /ready, against the import-to-ready
+#   time it reports itself. Each run is a cold start of the interpreter
+def bench_startup(work_dir: Path, runs: int) -> dict:
+    env = {**os.environ, 'GT_MODEL': str(save_model(work_dir)), 'PYTHONPATH': str(REPO_PATH)}
+
+    spawn_to_ready = []
+    import_to_ready = []
+    for run in range(runs):
+        log(f'startup: run {run + 1}/{runs}')
+        port = get_free_port()
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'model_server:app', '--port', str(port), '--log-level', 'warning'],
+                                   cwd=REPO_PATH, env=env, stdout=subprocess.DEVNULL)
+        try:
+            ready = wait_until_ready(f'http://127.0.0.1:{port}')
+            spawn_to_ready.append(time.perf_counter() - start)
+            import_to_ready.append(ready['import_to_ready_seconds'])
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {
+        'runs': runs,
+        'spawn_to_ready': summarize(spawn_to_ready),
+        'import_to_ready': summarize(import_to_ready)
+    }
+
+# /predict over HTTP from 'clients' concurrent clients, against a uvicorn
+#   server on a background thread. The prediction cache is off so every
+#   request reaches the model
+def bench_predict(work_dir: Path, clients: int, requests_per_client: int) -> dict:
+    os.environ['GT_MODEL'] = str(save_model(work_dir))
+    os.environ['GT_CACHE_SIZE'] = '0'
+
+    # Imported here because model_server loads GT_MODEL at import
+    import uvicorn
+    import model_server
+
+    port = get_free_port()
+    server = uvicorn.Server(uvicorn.Config(model_server.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    url = f'http://127.0.0.1:{port}'
+    wait_until_ready(url)
+    contents = [path.read_bytes() for path in make_images(work_dir/'predict', list(range(clients)))]
+
+    def run_client(client: int) -> list[float]:
+        session = requests.Session()
+        timings = []
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            response = session.post(f'{url}/predict', files={'img': ('screenshot.jpeg', contents[client])})
+            response.raise_for_status()
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    log(f'predict: {clients} clients x {requests_per_client} requests')
+    run_client(0) # Warm-up
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        timings = [timing for client_timings in executor.map(run_client, range(clients)) for timing in client_timings]
+    elapsed = time.perf_counter() - start
+
+    batch_size = requests.get(f'{url}/stats').json()['batch_size']
+
+    server.should_exit = True
+    thread.join()
+
+    return {
+        'clients': clients,
+        'latency': summarize(timings),
+        'requests_per_sec': len(timings) / elapsed,
+        'mean_batch_size': batch_size['sum'] / max(batch_size['count'], 1)
+    }
+
+# The scraper against the local stub: search result pages while listing
+#   games, then whole games (store page, screenshot download, DB row)
+def bench_scraper(work_dir: Path, games_per_tag: int, concurrency: int) -> dict:
+    server, base_url = start_server(games_per_tag=games_per_tag)
+
+    scraper.STORE_URL = base_url
+    scraper.API_URL = base_url
+    # With the response cache, as the scraper runs by default
+    scraper.fetcher = Fetcher(max_concurrency=concurrency, rate_per_host=1e9, burst=concurrency,
+                              cache=ResponseCache(work_dir/'http_cache.db'))
+    scraper.manifest = None
+    scraper.get_store_page.cache_clear()
+    scraper.get_app_details.cache_clear()
+
+    tags = list(scraper.tag_dict.keys())
+
+    log(f'scraper: listing {games_per_tag} games for {len(tags)} tags')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(tags)) as executor:
+        list(executor.map(lambda tag: scraper.get_games_by_tag(tag, games_per_tag), tags))
+    search_time = time.perf_counter() - start
+    search_pages = len(tags) * -(-games_per_tag // 100)
+
+    download_dir = work_dir/'scraped'
+    download_dir.mkdir()
+    scraper.writer = TagWriter(scraper.tag_dict, download_dir/'tag_info.db')
+    scraper.writer.start()
+
+    log('scraper: downloading games')
+    start = time.perf_counter()
+    with quiet(), ThreadPoolExecutor(concurrency) as game_executor, ThreadPoolExecutor(len(tags)) as tag_executor:
+        futures = [tag_executor.submit(scraper.download_ss_for_tag, tag, download_dir, games_per_tag, game_executor) for tag in tags]
+        for future in futures:
+            future.result()
+        scraper.writer.close()
+    download_time = time.perf_counter() - start
+
+    server.shutdown()
+
+    games = scraper.writer.rows_written
+    return {
+        'games_per_tag': games_per_tag,
+        'concurrency': concurrency,
+        'search_pages_per_sec': search_pages / search_time,
+        'games_written': games,
+        'games_per_sec': games / download_time,
+        # A store page and a screenshot per game
+        'pages_per_sec': 2 * games / download_time
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the scraper, data loading, training and serving on synthetic data and prints the results as JSON')
+    parser.add_argument('benchmarks', nargs='*', help=f'Benchmarks to run (default: all of {", ".join(BENCHMARKS)})', default=BENCHMARKS)
+    parser.add_argument('-o', '--output', type=Path, help='Also write the JSON results to this file', default=None)
+    parser.add_argument('--quick', action='store_true', help='Small sizes for a fast smoke run')
+    parser.add_argument('--rows', type=int, help='Screenshots in the synthetic dataset', default=200)
+    parser.add_argument('--split-rows', type=int, nargs='+', help='Games table sizes for the split benchmark', default=[1000, 10000, 100000])
+    parser.add_argument('-b', '--batch-size', type=int, help='Batch size for data loading and training', default=8)
+    parser.add_argument('-w', '--workers', type=int, help='DataLoader workers', default=os.cpu_count())
+    parser.add_argument('--train-steps', type=int, help='Timed optimizer steps', default=5)
+    parser.add_argument('--amp', action='store_true', help='Also time training under bfloat16 autocast')
+    parser.add_argument('--pred-calls', type=int, help='Timed get_pred calls', default=20)
+    parser.add_argument('--startup-runs', type=int, help='Server cold starts to time', default=3)
+    parser.add_argument('--clients', type=int, help='Concurrent /predict clients', default=8)
+    parser.add_argument('--requests', type=int, help='Requests per /predict client', default=10)
+    parser.add_argument('--games-per-tag', type=int, help='Games the stub lists per tag', default=200)
+    parser.add_argument('-j', '--concurrency', type=int, help='Scraper requests in flight', default=16)
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    if args.quick:
+        args.rows = 24
+        args.split_rows = [1000, 10000]
+        args.train_steps = 2
+        args.pred_calls = 5
+        args.startup_runs = 1
+        args.clients = 4
+        args.requests = 3
+        args.games_per_tag = 20
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'args': {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()}
+        },
+        'results': {}
+    }
+
+    argv = sys.argv
+    with tempfile.TemporaryDirectory() as directory:
+        work_dir = Path(directory)
+
+        runs = {
+            'dataset': lambda: bench_dataset(work_dir, args.rows, args.batch_size, args.workers),
+            'split': lambda: bench_split(work_dir, args.split_rows),
+            'training': lambda: bench_training(args.batch_size, args.train_steps, args.amp),
+            'get_pred': lambda: bench_get_pred(work_dir, args.pred_calls),
+            'startup': lambda: bench_startup(work_dir, args.startup_runs),
+            'predict': lambda: bench_predict(work_dir, args.clients, args.requests),
+            'scraper': lambda: bench_scraper(work_dir, args.games_per_tag, args.concurrency)
+        }
+
+        for name in BENCHMARKS:
+            if name not in args.benchmarks:
+                continue
+
+            start = time.perf_counter()
+            report['results'][name] = runs[name]()
+            log(f'✅ {name} ({time.perf_counter() - start:.1f}s)')
+
+    sys.argv = argv
+
+    output = json.dumps(report, indent=4)
+    print(output)
+    if args.output is not None:
+        args.output.write_text(output)
+
+if __name__ == "__main__":
+    main()
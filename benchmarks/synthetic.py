@@ -0,0 +1,62 @@
+import sqlite3
+import numpy as np
+from pathlib import Path
+from PIL import Image
+from tags import tag_dict
+from tag_db import create_table, TABLE
+
+# Rough share of games carrying each tag, so label statistics and the
+#   stratified split see realistic imbalance
+TAG_PREVALENCE = 0.25
+
+# A screenshot-like image: smooth gradients with a little noise, so it
+#   compresses roughly like a real one (~350 KB at 1920x1080)
+def make_screenshot(rng: np.random.Generator, width: int, height: int) -> Image.Image:
+    y, x = np.mgrid[0:height, 0:width]
+    phase = rng.uniform(0, 2 * np.pi, 3)
+    channels = [127 + 100 * np.sin(x / (40 + 20 * c) + y / (60 + 10 * c) + phase[c]) for c in range(3)]
+    pixels = np.stack(channels, axis=-1) + rng.normal(0, 4, (height, width, 3))
+    return Image.fromarray(pixels.clip(0, 255).astype(np.uint8))
+
+# Writes one JPEG per name into 'directory' and returns their paths
+def make_images(directory: Path, names: list, width: int = 1920, height: int = 1080, seed: int = 0) -> list[Path]:
+    rng = np.random.default_rng(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    for name in names:
+        path = directory/f'{name}.jpeg'
+        make_screenshot(rng, width, height).save(path, quality=90)
+        paths.append(path)
+
+    return paths
+
+# A games table shaped like the scraper's, with random tags for 'app_ids'
+def make_tag_db(db_path: Path, app_ids: list[int], seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    labels = (rng.random((len(app_ids), len(tag_dict))) < TAG_PREVALENCE).astype(int)
+
+    connection = sqlite3.connect(db_path)
+    create_table(connection, list(tag_dict.keys()))
+    connection.executemany(f'INSERT INTO {TABLE} VALUES ({", ".join("?" * (len(tag_dict) + 1))})',
+                           [(app_id, *row) for app_id, row in zip(app_ids, labels.tolist())])
+    connection.commit()
+    connection.close()
+
+# A data directory like the scraper leaves behind: data_path/tag_info.db and
+#   data_path/<app_id>.jpeg for 'rows' games
+def make_dataset(data_path: Path, rows: int, width: int = 1920, height: int = 1080, seed: int = 0) -> list[int]:
+    app_ids = list(range(1000, 1000 + rows))
+    make_images(data_path, app_ids, width, height, seed)
+    make_tag_db(data_path/'tag_info.db', app_ids, seed)
+    return app_ids
+
+# p50/p99/mean of per-call timings in seconds, reported in milliseconds
+def summarize(timings: list[float]) -> dict:
+    timings = np.array(timings)
+    return {
+        'count': len(timings),
+        'p50_ms': float(np.percentile(timings, 50) * 1000),
+        'p99_ms': float(np.percentile(timings, 99) * 1000),
+        'mean_ms': float(timings.mean() * 1000)
+    }
@@ -0,0 +1,75 @@
+import os
+import random
+import torch
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+
+LATEST = 'latest.pt'
+BEST = 'best.pt'
+
+def get_rng_state() -> dict:
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'random': random.getstate()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state: dict) -> None:
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+# Copies every tensor to the CPU so training can keep mutating the originals
+#   while the copy is written
+def snapshot(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+# Writes checkpoints on a background thread. The training loop only pays for
+#   the CPU snapshot; the next save waits for the previous write, so at most
+#   one is ever in flight. Files are replaced atomically, so a crash mid-write
+#   leaves the previous checkpoint intact
+class CheckpointWriter:
+    def __init__(self, checkpoint_dir: Path) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.pending: Future | None = None
+
+    def save(self, state: dict, is_best: bool = False) -> None:
+        self.wait()
+        self.pending = self.executor.submit(self.write, snapshot(state), is_best)
+
+    def write(self, state: dict, is_best: bool) -> None:
+        names = [LATEST, BEST] if is_best else [LATEST]
+        for name in names:
+            path = self.checkpoint_dir/name
+            tmp_path = path.with_suffix('.tmp')
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+
+    def wait(self) -> None:
+        if self.pending is not None:
+            self.pending.result() # Re-raises a failed write here
+            self.pending = None
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+# Loaded to the CPU: RNG states have to be CPU tensors, and load_state_dict
+#   copies the model and optimizer state to their parameters' device
+def load_checkpoint(path: Path) -> dict:
+    # RNG states hold NumPy objects, so this can't use weights_only
+    return torch.load(path, map_location='cpu', weights_only=False)
@@ -1,52 +1,90 @@
+import os
+import json
 import torch
 import sqlite3
+import numpy as np
 from PIL import Image
 from pathlib import Path
 from torchvision import transforms
 from torch.utils.data import Dataset
 
 class CustomDataset(Dataset):
-    def __init__(self, data_path: Path, db_file: str, table: str, transform=transforms.Compose([transforms.ToTensor()])) -> None:
+    def __init__(self, data_path: Path, db_file: str, table: str, transform=transforms.Compose([transforms.ToTensor()]), shard_path: Path | None = None) -> None:
         self.data_path = data_path
         self.db_path = data_path/db_file
         self.table = table
-        self.classes = self.get_classes(self.db_path) 
         self.transform = transform
 
-    def __len__(self) -> int:
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
+        # When set, images are read as uint8 CHW tensors from a shard built by
+        #   preprocess.py and 'transform' is not applied
+        self.shard_path = shard_path
+        self._images = None
 
-        result = cursor.execute(
-                f'''
-                SELECT count(*) from {self.table};
-                '''
-        )
+        # One connection per process, reopened lazily after a DataLoader worker forks
+        self._connection = None
+        self._connection_pid = None
 
-        length = result.fetchone()[0]
-        connection.close()
-        return length
+        if shard_path is None:
+            self.classes = self.get_classes(self.db_path)
+            self.app_ids, self.labels = self.load_rows()
+        else:
+            self.classes = json.loads((shard_path/'meta.json').read_text())['classes']
+            self.app_ids = np.load(shard_path/'app_ids.npy')
+            self.labels = np.load(shard_path/'labels.npy')
+
+    def __len__(self) -> int:
+        return len(self.app_ids)
 
     def __getitem__(self, index: int) -> tuple[torch.Tensor, torch.Tensor]:
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        
-        result = cursor.execute(
-                f'''
-                SELECT * from {self.table} LIMIT 1 OFFSET {index};
-                '''
-        )
+        if self.shard_path is not None:
+            return (torch.from_numpy(self.get_images()[index]), torch.from_numpy(self.labels[index]).float())
 
-        row = result.fetchone()
-        app_id = row[0]
-        tag_info = list(row[1:])
+        app_id = self.app_ids[index]
 
         img = Image.open(self.data_path/f'{app_id}.jpeg')
         transformed_img = self.transform(img)
 
-        connection.close()
+        return (transformed_img, torch.from_numpy(self.labels[index]).float())
+
+    def __getstate__(self) -> dict:
+        # sqlite3 connections can't be pickled, so spawned workers open their own
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_connection_pid'] = None
+        state['_images'] = None
+        return state
+
+    # Opened lazily so each worker maps the file itself instead of receiving
+    #   a pickled copy of the array. Copy-on-write keeps the views writable
+    #   for torch.from_numpy without ever touching the file
+    def get_images(self) -> np.ndarray:
+        if self._images is None:
+            self._images = np.load(self.shard_path/'images.npy', mmap_mode='c')
+
+        return self._images
+
+    def get_connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.db_path)
+            self._connection_pid = os.getpid()
+
+        return self._connection
+
+    # Reads the whole table in a single pass. Returns the app ids and a
+    #   uint8 label matrix, both indexed by position in the table
+    def load_rows(self) -> tuple[np.ndarray, np.ndarray]:
+        cursor = self.get_connection().cursor()
+
+        columns = ', '.join(['app_id'] + self.classes)
+        result = cursor.execute(
+                f'''
+                SELECT {columns} FROM {self.table} ORDER BY rowid;
+                '''
+        )
+
+        rows = np.array(result.fetchall(), dtype=np.int64).reshape(-1, len(self.classes) + 1)
 
-        return (transformed_img, torch.tensor(tag_info, dtype=torch.float32))
+        return (rows[:, 0].copy(), rows[:, 1:].astype(np.uint8))
 
     def get_classes(self, db_file: Path) -> list[str]:
         connection = sqlite3.connect(db_file)
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import torch
+import inference
+from pathlib import Path
+from torch.utils.data import DataLoader
+from prediction_cache import get_model_version
+from tag_images import ImagePathDataset, collate
+from preprocessing import ImagePreprocessor
+
+# ---- Configuration ----
+DATA_PATH = Path('data')
+EMBEDDING_DIR = Path('embeddings')
+MODEL_PATH = Path('models/d5000e30.pt')
+BATCH_SIZE = 64
+
+# The IVF index is built once there are this many games; below that an
+#   exhaustive search is already fast
+IVF_MIN_ROWS = 10000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 100000
+NPROBE = 8 # Lists searched per query
+SEARCH_CHUNK = 65536 # Rows converted to float32 at a time in an exhaustive search
+
+# ------------------------
+
+# Screenshots are saved by the scraper as data/<app_id>.jpeg
+def get_screenshots(data_path: Path) -> dict[int, str]:
+    return {int(path.stem): str(path) for path in sorted(data_path.glob('*.jpeg')) if path.stem.isdigit()}
+
+# Unit length, so the cosine similarity of two rows is their dot product
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# Similarity of every row of a float16 'matrix' to 'vector'. NumPy's float16
+#   to float32 cast isn't vectorized and costs more than the product itself,
+#   so both run through torch on the same memory
+def get_scores(matrix: np.ndarray, vector: torch.Tensor) -> np.ndarray:
+    return (torch.from_numpy(matrix).float() @ vector).numpy()
+
+# Spherical k-means on (a sample of) the normalized rows; returns unit-length
+#   centroids, at most one per sampled row
+def get_centroids(embeddings: np.ndarray, list_count: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(embeddings), size=min(len(embeddings), KMEANS_SAMPLE), replace=False)
+    vectors = np.asarray(embeddings[np.sort(sample)], dtype=np.float32)
+
+    list_count = min(list_count, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=list_count, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = assign_lists(vectors, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = np.bincount(assignments, minlength=list_count) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))] # Restart empty lists
+        centroids = normalize(sums)
+
+    return centroids
+
+def assign_lists(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), SEARCH_CHUNK):
+        chunk = np.asarray(embeddings[start:start + SEARCH_CHUNK], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+# An inverted file index: every row belongs to the list of its nearest
+#   centroid. 'order' sorts the rows by list; once they are stored in that
+#   order list i is rows offsets[i] to offsets[i + 1]
+def build_ivf(embeddings: np.ndarray, list_count: int | None = None) -> dict:
+    list_count = list_count or max(1, int(4 * np.sqrt(len(embeddings))))
+    centroids = get_centroids(embeddings, list_count)
+    assignments = assign_lists(embeddings, centroids)
+
+    order = np.argsort(assignments, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+    return {'centroids': centroids, 'order': order, 'offsets': offsets}
+
+# Embeds every screenshot in 'data_path' with 'model_save_path' into
+#   'output': embeddings.npy (float16, one unit-length row per game),
+#   app_ids.npy (the game of each row), meta.json and, with enough games (or
+#   'list_count'), ivf.npz. Rows already embedded by the same model are
+#   copied instead of computed again. list_count=0 skips the index
+def build_embeddings(model_save_path: Path = MODEL_PATH, data_path: Path = DATA_PATH, output: Path = EMBEDDING_DIR,
+                     batch_size: int = BATCH_SIZE, num_workers: int | None = None, list_count: int | None = None) -> Path:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model_version = get_model_version(model_save_path)
+    meta = inference.load_meta(model_save_path)
+    model = inference.load_model(model_save_path, device, meta)
+
+    screenshots = get_screenshots(data_path)
+    app_ids = np.array(list(screenshots.keys()), dtype=np.int64)
+
+    reusable = {}
+    if (output/'meta.json').exists() and json.loads((output/'meta.json').read_text())['model_version'] == model_version:
+        old = EmbeddingIndex(output)
+        reusable = {app_id: (old.embeddings, row) for app_id, row in old.rows.items()}
+
+    tmp_path = output.with_name(f'.{output.name}.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    to_embed = [index for index, app_id in enumerate(app_ids.tolist()) if app_id not in reusable]
+    print(f'Reusing {len(app_ids) - len(to_embed)} embeddings, embedding {len(to_embed)} screenshots')
+
+    embeddings = None
+    failed = []
+    start = time.perf_counter()
+
+    # The hidden size comes from the model, so the matrix is allocated once
+    #   the first batch is embedded
+    def allocate(dim: int) -> np.ndarray:
+        return np.lib.format.open_memmap(tmp_path/'embeddings.npy', mode='w+', dtype=np.float16, shape=(len(app_ids), dim))
+
+    if len(to_embed) > 0:
+        loader = DataLoader(dataset=ImagePathDataset([screenshots[app_ids[index]] for index in to_embed], ImagePreprocessor(meta.image_size)),
+                            batch_size=batch_size,
+                            num_workers=os.cpu_count() if num_workers is None else num_workers,
+                            collate_fn=collate)
+        row_of = {screenshots[app_ids[index]]: index for index in to_embed}
+
+        for i, (batch, paths, batch_failed) in enumerate(loader, 1):
+            failed.extend(batch_failed)
+            if batch is None:
+                continue
+
+            vectors = normalize(inference.get_embeddings(model, batch, device).numpy())
+            if embeddings is None:
+                embeddings = allocate(vectors.shape[1])
+            embeddings[[row_of[path] for path in paths]] = vectors
+
+            if i % 10 == 0:
+                print(f'{i}/{len(loader)} batches | {i * batch_size / (time.perf_counter() - start):.1f} images/sec')
+
+    if embeddings is None:
+        if len(reusable) == 0:
+            raise ValueError(f'No screenshots could be embedded from {data_path}')
+        embeddings = allocate(next(iter(reusable.values()))[0].shape[1])
+
+    for index, app_id in enumerate(app_ids.tolist()):
+        if app_id in reusable:
+            source, row = reusable[app_id]
+            embeddings[index] = source[row]
+
+    # Screenshots that couldn't be decoded are left out
+    failed_rows = {row_of[path] for path, _ in failed} if failed else set()
+    for path, error in failed:
+        print(f'❌ {path}: {error}')
+    if failed_rows:
+        keep = np.array([index not in failed_rows for index in range(len(app_ids))])
+        kept = np.asarray(embeddings[keep])
+        del embeddings
+        app_ids = app_ids[keep]
+        embeddings = np.lib.format.open_memmap(tmp_path/'embeddings.npy', mode='w+', dtype=np.float16, shape=kept.shape)
+        embeddings[:] = kept
+
+    embeddings.flush()
+
+    # Rows are stored grouped by list, so a search reads each list it probes
+    #   as one contiguous slice
+    if list_count != 0 and (list_count is not None or len(app_ids) >= IVF_MIN_ROWS):
+        ivf = build_ivf(embeddings, list_count)
+        order = ivf.pop('order')
+
+        grouped = np.lib.format.open_memmap(tmp_path/'grouped.npy', mode='w+', dtype=np.float16, shape=embeddings.shape)
+        for position in range(0, len(order), SEARCH_CHUNK):
+            grouped[position:position + SEARCH_CHUNK] = embeddings[order[position:position + SEARCH_CHUNK]]
+        grouped.flush()
+        del embeddings, grouped
+        (tmp_path/'grouped.npy').replace(tmp_path/'embeddings.npy')
+        embeddings = np.load(tmp_path/'embeddings.npy', mmap_mode='r')
+        app_ids = app_ids[order]
+
+        np.savez(tmp_path/'ivf.npz', **ivf)
+        print(f'Built an IVF index with {len(ivf["centroids"])} lists')
+
+    np.save(tmp_path/'app_ids.npy', app_ids)
+    (tmp_path/'meta.json').write_text(json.dumps({
+        'model': str(model_save_path),
+        'model_version': model_version,
+        'dim': embeddings.shape[1],
+        'count': len(app_ids),
+        'dtype': 'float16'
+    }))
+    del embeddings
+
+    # Swap the new directory in, as preprocess.py does for shards
+    shutil.rmtree(output, ignore_errors=True)
+    tmp_path.rename(output)
+
+    print(f'✅ Embedded {len(app_ids)} games into {output} in {time.perf_counter() - start:.1f}s')
+    return output
+
+# The embeddings in 'directory', memory-mapped, with cosine top-k search.
+#   Searches scan every row, or with an IVF index only the 'nprobe' lists
+#   whose centroids are closest to the query
+class EmbeddingIndex:
+    def __init__(self, directory: Path = EMBEDDING_DIR) -> None:
+        self.directory = Path(directory)
+        self.meta = json.loads((self.directory/'meta.json').read_text())
+        self.embeddings = np.load(self.directory/'embeddings.npy', mmap_mode='c') # Copy-on-write, so torch can wrap it; never written
+        self.app_ids = np.load(self.directory/'app_ids.npy')
+        self.rows = {app_id: row for row, app_id in enumerate(self.app_ids.tolist())}
+
+        self.ivf = None
+        if (self.directory/'ivf.npz').exists():
+            with np.load(self.directory/'ivf.npz') as ivf:
+                self.ivf = {name: ivf[name] for name in ivf.files}
+
+    def __len__(self) -> int:
+        return len(self.app_ids)
+
+    def get_vector(self, app_id: int) -> np.ndarray:
+        return np.asarray(self.embeddings[self.rows[app_id]], dtype=np.float32)
+
+    # Rows to score and their similarity to 'vector' (unit length)
+    def score(self, vector: np.ndarray, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        query = torch.from_numpy(vector)
+
+        if self.ivf is None:
+            scores = np.concatenate([get_scores(self.embeddings[start:start + SEARCH_CHUNK], query)
+                                     for start in range(0, len(self.embeddings), SEARCH_CHUNK)])
+            return (np.arange(len(scores)), scores)
+
+        centroids, offsets = self.ivf['centroids'], self.ivf['offsets']
+        nprobe = min(nprobe, len(centroids))
+        lists = np.argpartition(-(centroids @ vector), nprobe - 1)[:nprobe]
+
+        rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in lists])
+        scores = np.concatenate([get_scores(self.embeddings[offsets[i]:offsets[i + 1]], query) for i in lists])
+        return (rows, scores)
+
+    # The 'k' most similar games as (app_id, cosine similarity), best first
+    def search(self, vector: np.ndarray, k: int = 10, nprobe: int = NPROBE, exclude: int | None = None) -> list[tuple[int, float]]:
+        rows, scores = self.score(normalize(vector), nprobe)
+        if exclude is not None and exclude in self.rows:
+            scores = np.where(rows == self.rows[exclude], -np.inf, scores)
+
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.app_ids[rows[i]]), float(scores[i])) for i in top]
+
+    def similar(self, app_id: int, k: int = 10, nprobe: int = NPROBE) -> list[tuple[int, float]]:
+        return self.search(self.get_vector(app_id), k, nprobe, exclude=app_id)
+
+def main():
+    parser = argparse.ArgumentParser(description='Embeds every screenshot with a trained model and finds similar games')
+    parser.add_argument('-m', '--model', type=Path, help='Path to the model state dict', default=MODEL_PATH)
+    parser.add_argument('-d', '--data', type=Path, help='Directory with <app_id>.jpeg screenshots', default=DATA_PATH)
+    parser.add_argument('-o', '--output', type=Path, help='Directory for the embeddings and index', default=EMBEDDING_DIR)
+    parser.add_argument('-b', '--batch-size', type=int, help='Images per forward pass', default=BATCH_SIZE)
+    parser.add_argument('-w', '--workers', type=int, help='DataLoader workers decoding images', default=os.cpu_count())
+    parser.add_argument('-l', '--lists', type=int, help=f'IVF lists, at most one per game (default: 4 * sqrt(games) from {IVF_MIN_ROWS} games on; 0 for no index)', default=None)
+    parser.add_argument('-s', '--similar', type=int, help='Print the games most similar to this app_id instead of building')
+    parser.add_argument('-k', type=int, help='Number of similar games', default=10)
+    args = parser.parse_args()
+
+    if args.lists is not None and args.lists < 0:
+        parser.error('--lists must be 0 or more')
+
+    if args.similar is None:
+        build_embeddings(args.model, args.data, args.output, args.batch_size, args.workers, args.lists)
+        return
+
+    index = EmbeddingIndex(args.output)
+    for app_id, score in index.similar(args.similar, args.k):
+        print(f'{app_id}\t{score:.4f}')
+
+if __name__ == "__main__":
+    main()
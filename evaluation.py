@@ -0,0 +1,93 @@
+import torch
+from torch import distributed as dist
+
+# Collects the sigmoid outputs and labels of a whole split into tensors
+#   allocated once up front. Metrics are computed from them after the loop
+#   instead of per batch
+class EvalAccumulator:
+    def __init__(self, sample_count: int, label_count: int, device: str) -> None:
+        self.probs = torch.empty((sample_count, label_count), device=device)
+        self.labels = torch.empty((sample_count, label_count), dtype=torch.bool, device=device)
+        self.count = 0
+
+    def add(self, probs: torch.Tensor, labels: torch.Tensor) -> None:
+        end = self.count + len(probs)
+        self.probs[self.count:end] = probs
+        self.labels[self.count:end] = labels > 0.5
+        self.count = end
+
+    # Under DDP every rank holds an equally sized share, so all ranks end up
+    #   with the whole split. An unshuffled DistributedSampler deals sample i
+    #   to rank i % world_size and pads the last round with repeats of the
+    #   first samples; interleaving the shares restores the split's order,
+    #   which leaves the repeats at the end for 'sample_count' to cut off
+    def gather(self, sample_count: int | None = None) -> tuple[torch.Tensor, torch.Tensor]:
+        probs = self.probs[:self.count]
+        labels = self.labels[:self.count]
+
+        if dist.is_available() and dist.is_initialized():
+            probs = all_gather(probs)
+            labels = all_gather(labels.to(torch.uint8)).bool() # gloo can't gather bool
+
+        return probs[:sample_count], labels[:sample_count]
+
+# Row j of rank r's share becomes row j * world_size + r
+def all_gather(tensor: torch.Tensor) -> torch.Tensor:
+    shares = [torch.empty_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(shares, tensor.contiguous())
+    return torch.stack(shares, dim=1).flatten(0, 1)
+
+# True/false positive and negative counts per label, in one pass
+def get_confusion_counts(probs: torch.Tensor, labels: torch.Tensor, thresholds: torch.Tensor) -> dict[str, torch.Tensor]:
+    predicted = probs > thresholds.to(probs.device)
+
+    true_positives = (predicted & labels).sum(dim=0)
+    predicted_positives = predicted.sum(dim=0)
+    actual_positives = labels.sum(dim=0)
+
+    false_positives = predicted_positives - true_positives
+    false_negatives = actual_positives - true_positives
+
+    return {
+        'true_positives': true_positives,
+        'false_positives': false_positives,
+        'false_negatives': false_negatives,
+        'true_negatives': len(probs) - true_positives - false_positives - false_negatives
+    }
+
+# Per-label accuracy, precision, recall and F1. A ratio with nothing to
+#   divide by is 0
+def compute_metrics(counts: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+    tp, fp, fn, tn = [counts[key].float() for key in ['true_positives', 'false_positives', 'false_negatives', 'true_negatives']]
+
+    precision = tp / (tp + fp).clamp(min=1)
+    recall = tp / (tp + fn).clamp(min=1)
+
+    return {
+        'accuracy': (tp + tn) / (tp + fp + fn + tn).clamp(min=1),
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * tp / (2 * tp + fp + fn).clamp(min=1)
+    }
+
+# The threshold that maximizes each label's F1. Probabilities are sorted once
+#   per label, so F1 at every possible cut comes from cumulative sums: predicting
+#   the top k as positive gives F1 = 2 * tp_k / (k + positives). Thresholds sit
+#   halfway between the cut and the next probability. Labels without positives
+#   keep 'default'
+def find_thresholds(probs: torch.Tensor, labels: torch.Tensor, default: float = 0.5) -> torch.Tensor:
+    sorted_probs, order = probs.sort(dim=0, descending=True)
+    true_positives = labels.gather(0, order).float().cumsum(dim=0)
+    predicted_positives = torch.arange(1, len(probs) + 1, device=probs.device).unsqueeze(1)
+    actual_positives = true_positives[-1]
+
+    f1 = 2 * true_positives / (predicted_positives + actual_positives)
+
+    # No threshold separates equal probabilities
+    next_probs = torch.cat([sorted_probs[1:], torch.zeros_like(sorted_probs[:1])])
+    f1[sorted_probs == next_probs] = -1
+
+    best = f1.argmax(dim=0, keepdim=True)
+    thresholds = ((sorted_probs.gather(0, best) + next_probs.gather(0, best)) / 2).squeeze(0)
+
+    return torch.where(actual_positives > 0, thresholds, torch.full_like(thresholds, default))
@@ -0,0 +1,192 @@
+import copy
+import json
+import time
+import torch
+import argparse
+import inference
+import numpy as np
+from torch import nn
+from pathlib import Path
+from torch.utils.data import DataLoader
+from torch.ao import quantization
+from dataset import CustomDataset
+from model_meta import ModelMeta, replace_file
+from preprocessing import ImagePreprocessor
+
+# ---- Configuration ----
+DATA_PATH = Path('data')
+DB_FILE = 'tag_info.db'
+TABLE = 'test'
+
+# Conv+BN+ReLU triples in MultiLabelClassifier, plus the classifier's Linear+ReLU
+FUSE_GROUPS = [
+    ['conv_block_1.0', 'conv_block_1.1', 'conv_block_1.2'],
+    ['conv_block_1.4', 'conv_block_1.5', 'conv_block_1.6'],
+    ['conv_block_2.0', 'conv_block_2.1', 'conv_block_2.2'],
+    ['conv_block_2.4', 'conv_block_2.5', 'conv_block_2.6'],
+    ['conv_block_3.0', 'conv_block_3.1', 'conv_block_3.2'],
+    ['conv_block_3.3', 'conv_block_3.4', 'conv_block_3.5'],
+    ['classifier.3', 'classifier.4']
+]
+
+# ------------------------
+
+# Eager-mode static quantization needs explicit points where tensors enter
+#   and leave the int8 domain
+class QuantizableClassifier(nn.Module):
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.model = model
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.model(self.quant(x)))
+
+def fuse(model: nn.Module) -> nn.Module:
+    fused = copy.deepcopy(model).eval()
+    quantization.fuse_modules(fused, FUSE_GROUPS, inplace=True)
+    return fused
+
+def get_engine() -> str:
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+
+# Conv and linear weights and activations in int8, with activation ranges
+#   observed over 'calibration_batches' batches of the test split
+def quantize_static(model: nn.Module, loader: DataLoader, calibration_batches: int) -> nn.Module:
+    engine = get_engine()
+    torch.backends.quantized.engine = engine
+
+    quantizable = QuantizableClassifier(fuse(model)).eval()
+    quantizable.qconfig = quantization.get_default_qconfig(engine)
+    quantization.prepare(quantizable, inplace=True)
+
+    with torch.inference_mode():
+        for i, (inputs, _) in enumerate(loader):
+            if i == calibration_batches:
+                break
+            quantizable(inputs)
+
+    return quantization.convert(quantizable)
+
+# Only the linear layers are quantized, at run time; the fused convolutions
+#   stay in fp32. Needs no calibration
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    torch.backends.quantized.engine = get_engine()
+    return quantization.quantize_dynamic(fuse(model), {nn.Linear}, dtype=torch.qint8)
+
+# The test split at the model's image size. Its label columns have to be the
+#   model's outputs, in the same order, for the accuracy to mean anything
+def get_test_loader(batch_size: int, workers: int, meta: ModelMeta) -> DataLoader:
+    test_data = CustomDataset(data_path=DATA_PATH,
+                              db_file=DB_FILE,
+                              table=TABLE,
+                              transform=ImagePreprocessor(meta.image_size))
+
+    if test_data.classes != meta.labels:
+        raise ValueError(f'The {TABLE} split has labels {test_data.classes}, the model {meta.labels}')
+
+    return DataLoader(dataset=test_data, batch_size=batch_size, num_workers=workers)
+
+def evaluate(model: nn.Module, loader: DataLoader, thresholds: torch.Tensor) -> dict:
+    correct = 0
+    exact = 0
+    true_positives = 0
+    predicted_positives = 0
+    actual_positives = 0
+    count = 0
+
+    with torch.inference_mode():
+        for inputs, labels_truth in loader:
+            labels_pred = (torch.sigmoid(model(inputs)) > thresholds).float()
+
+            correct += (labels_pred == labels_truth).sum().item()
+            exact += (labels_pred == labels_truth).all(dim=1).sum().item()
+            true_positives += (labels_pred * labels_truth).sum().item()
+            predicted_positives += labels_pred.sum().item()
+            actual_positives += labels_truth.sum().item()
+            count += len(inputs)
+
+    precision = true_positives / max(predicted_positives, 1)
+    recall = true_positives / max(actual_positives, 1)
+
+    return {
+        'label_accuracy': correct / max(count * len(thresholds), 1),
+        'exact_match': exact / max(count, 1),
+        'micro_f1': 2 * precision * recall / max(precision + recall, 1e-12)
+    }
+
+def measure_latency(model: nn.Module, batch_size: int, image_size: int, runs: int = 20) -> dict:
+    inputs = torch.rand(batch_size, 3, image_size, image_size)
+
+    with torch.inference_mode():
+        for _ in range(3): # Warm-up
+            model(inputs)
+
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(inputs)
+            timings.append(time.perf_counter() - start)
+
+    timings = np.array(timings)
+    return {
+        'batch_size': batch_size,
+        'p50_ms': float(np.percentile(timings, 50) * 1000),
+        'p99_ms': float(np.percentile(timings, 99) * 1000),
+        'images_per_sec': float(batch_size / timings.mean())
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports an int8-quantized TorchScript model for CPU serving')
+    parser.add_argument('-m', '--model', type=Path, help='Path to the fp32 state dict', default=Path('models/d5000e30.pt'))
+    parser.add_argument('-o', '--output', type=Path, help='Path of the TorchScript artifact (default: <model>.int8.ts)', default=None)
+    parser.add_argument('--mode', choices=['static', 'dynamic'], help='Quantization mode', default='static')
+    parser.add_argument('-c', '--calibration-batches', type=int, help='Test batches used to calibrate static quantization', default=32)
+    parser.add_argument('-b', '--batch-size', type=int, help='Batch size for calibration, evaluation and throughput', default=32)
+    parser.add_argument('-w', '--workers', type=int, help='DataLoader workers', default=0)
+    parser.add_argument('--no-report', action='store_true', help='Skip the accuracy and latency comparison')
+    args = parser.parse_args()
+
+    output = args.output or args.model.with_suffix('.int8.ts')
+
+    meta = inference.load_meta(args.model)
+    model = inference.load_model(args.model, 'cpu', meta)
+    loader = get_test_loader(args.batch_size, args.workers, meta)
+
+    if args.mode == 'static':
+        quantized = quantize_static(model, loader, args.calibration_batches)
+    else:
+        quantized = quantize_dynamic(model)
+
+    scripted = torch.jit.freeze(torch.jit.trace(quantized, torch.rand(1, 3, meta.image_size, meta.image_size)))
+    replace_file(output, lambda tmp_path: torch.jit.save(scripted, str(tmp_path)))
+    print(f'Saved {args.mode} int8 model to {output}')
+
+    if args.no_report:
+        return
+
+    # Both models are scored at the fp32 model's tuned thresholds, which the
+    #   exported artifact shares through the same sidecar
+    thresholds = torch.tensor(meta.thresholds)
+    report = {'mode': args.mode, 'engine': torch.backends.quantized.engine, 'threads': torch.get_num_threads()}
+    for name, candidate in [('fp32', model), ('int8', scripted)]:
+        report[name] = {
+            'accuracy': evaluate(candidate, loader, thresholds),
+            'latency': [measure_latency(candidate, 1, meta.image_size), measure_latency(candidate, args.batch_size, meta.image_size)],
+            'size_mb': (args.model if name == 'fp32' else output).stat().st_size / 1e6
+        }
+
+    report_path = output.with_suffix('.report.json')
+    report_path.write_text(json.dumps(report, indent=4))
+
+    for name in ['fp32', 'int8']:
+        accuracy = report[name]['accuracy']
+        single, batched = report[name]['latency']
+        print(f'{name}: label accuracy {accuracy["label_accuracy"]:.4f} | micro F1 {accuracy["micro_f1"]:.4f} | '
+              f'batch 1 p50 {single["p50_ms"]:.1f} ms | {batched["images_per_sec"]:.1f} images/sec at batch {batched["batch_size"]}')
+    print(f'Report written to {report_path}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import json
+import time
+import random
+import sqlite3
+import threading
+import requests
+from pathlib import Path
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+# Statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Blocks until a token is available
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+# Stands in for requests.Response when a response comes from the cache
+class CachedResponse:
+    def __init__(self, url: str, status_code: int, headers: dict, content: bytes, encoding: str | None) -> None:
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = True
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self) -> None:
+        pass
+
+# On-disk cache of successful responses, keyed by the request (see
+#   Fetcher.get_cache_key). Entries older than the TTL given to get() are
+#   ignored, and the least recently used entries are evicted once the bodies
+#   add up to more than 'max_bytes'
+class ResponseCache:
+    def __init__(self, path: Path, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                final_url TEXT,
+                status INTEGER,
+                headers TEXT,
+                encoding TEXT,
+                body BLOB,
+                size INTEGER,
+                fetched_at REAL,
+                accessed_at REAL
+            )
+            '''
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at)')
+        self.total_bytes = self.connection.execute('SELECT coalesce(sum(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url: str, ttl: float) -> CachedResponse | None:
+        now = time.time()
+
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT final_url, status, headers, encoding, body FROM responses WHERE url = ? AND fetched_at >= ?',
+                (url, now - ttl)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            with self.connection:
+                self.connection.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (now, url))
+
+        final_url, status, headers, encoding, body = row
+        return CachedResponse(final_url, status, json.loads(headers), body, encoding)
+
+    def put(self, url: str, response: requests.Response) -> None:
+        body = response.content
+        now = time.time()
+
+        with self._lock:
+            previous = self.connection.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, response.url, response.status_code, json.dumps(dict(response.headers)),
+                     response.encoding, body, len(body), now, now)
+                )
+
+            self.total_bytes += len(body) - (previous[0] if previous else 0)
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    # Drops least recently used entries until the cache is at 90% of its limit
+    def evict(self) -> None:
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute('SELECT url, size FROM responses ORDER BY accessed_at')
+
+        evicted = []
+        for url, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((url,))
+            self.total_bytes -= size
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM responses WHERE url = ?', evicted)
+
+# Thread-safe HTTP client shared by every scraper thread. Connections are kept
+#   alive in one pooled session, at most 'max_concurrency' requests are in
+#   flight at once, each host gets its own token bucket, and 429/5xx
+#   responses or connection errors are retried with exponential backoff.
+#   Requests made with a 'ttl' are served from 'cache' when possible
+class Fetcher:
+    def __init__(self, max_concurrency: int = 16, rate_per_host: float = 5.0, burst: int = 10,
+                 max_retries: int = 5, backoff: float = 0.5, timeout: float = 10,
+                 cache: ResponseCache | None = None) -> None:
+        self.cache = cache
+        self.rate_per_host = rate_per_host
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Mozilla/5.0'
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, host: str) -> TokenBucket:
+        with self._lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate_per_host, self.burst)
+            return self.buckets[host]
+
+    # Honors a numeric Retry-After header, otherwise backs off exponentially
+    #   with jitter so retrying threads don't synchronize
+    def get_delay(self, attempt: int, response: requests.Response | None) -> float:
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return float(retry_after)
+
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    # The URL plus any query parameters and cookies passed with it, so a
+    #   request with the age check cookies is never answered with the cached
+    #   response to one without them
+    def get_cache_key(self, url: str, kwargs: dict) -> str:
+        extra = {name: kwargs[name] for name in ['params', 'cookies'] if kwargs.get(name)}
+        if len(extra) == 0:
+            return url
+        return f'{url} {json.dumps(extra, sort_keys=True, default=str)}'
+
+    def get(self, url: str, ttl: float | None = None, **kwargs) -> requests.Response | CachedResponse:
+        use_cache = self.cache is not None and ttl is not None
+        key = self.get_cache_key(url, kwargs)
+
+        if use_cache:
+            cached = self.cache.get(key, ttl)
+            if cached is not None:
+                return cached
+
+        response = self.fetch(url, **kwargs)
+
+        if use_cache and response.status_code == 200:
+            self.cache.put(key, response)
+
+        return response
+
+    def fetch(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self.get_bucket(urlsplit(url).netloc)
+
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+
+            response = None
+            error = None
+            with self.semaphore:
+                try:
+                    response = self.session.get(url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                return response
+
+            if attempt == self.max_retries:
+                if response is not None:
+                    return response
+                raise error
+
+            if response is not None:
+                response.close()
+
+            time.sleep(self.get_delay(attempt, response))
@@ -34,7 +34,6 @@
 				torchWithCuda
 				matplotlib
 				torchvision
-				torchmetrics
 				fastapi
 				uvicorn
 				python-multipart
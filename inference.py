@@ -0,0 +1,69 @@
+import torch
+from pathlib import Path
+from PIL import Image
+from model import MultiLabelClassifier
+from model_meta import ModelMeta, load_meta as load_model_meta
+from preprocessing import ImagePreprocessor, to_float
+from tags import tag_dict
+
+labels = list(tag_dict.keys()) # For models saved without a manifest
+threshold = 0.5 # Used for tags without a tuned threshold
+
+preprocessor = ImagePreprocessor(size=256)
+data_transform = preprocessor # Float output, for code still expecting a torchvision transform
+
+# The model's <name>.meta.json manifest: labels, tuned thresholds and architecture
+def load_meta(model_save_path: Path) -> ModelMeta:
+    return load_model_meta(model_save_path, labels, threshold)
+
+def load_thresholds(model_save_path: Path) -> list[float]:
+    return load_meta(model_save_path).thresholds
+
+# State dicts are loaded into an eager MultiLabelClassifier. TorchScript
+#   artifacts (.ts, e.g. the int8 models from export.py) carry their own
+#   architecture and are loaded as-is
+def load_model(model_save_path: Path, device: str, meta: ModelMeta | None = None) -> torch.nn.Module:
+    if Path(model_save_path).suffix == '.ts':
+        model = torch.jit.load(model_save_path, map_location=torch.device(device))
+        model.eval()
+        return model
+
+    meta = meta or load_meta(model_save_path)
+
+    # Built on the meta device, so no memory is allocated or initialized for
+    #   weights that are replaced right away. The state dict is memory-mapped
+    #   and its tensors become the parameters, so the weights are paged in
+    #   from the file as they are used instead of being read and copied up front
+    with torch.device('meta'):
+        model = MultiLabelClassifier(in_count = 3, hidden_count = meta.hidden_count, out_count = len(meta.labels))
+    state_dict = torch.load(model_save_path, map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+
+    model.to(device)
+    model.eval()
+    return model
+
+# Returns sigmoid probabilities for a batch of preprocessed images, uint8
+#   (scaled on the device) or float
+def get_probs(model: torch.nn.Module, batch: torch.Tensor, device: str) -> torch.Tensor:
+    with torch.inference_mode():
+        pred_logits = model(to_float(batch.to(device)))
+        return torch.sigmoid(pred_logits).cpu()
+
+# The hidden representation before the last layer, see MultiLabelClassifier.embed
+def get_embeddings(model: torch.nn.Module, batch: torch.Tensor, device: str) -> torch.Tensor:
+    if not hasattr(model, 'embed'):
+        raise ValueError('Embeddings need an eager MultiLabelClassifier, TorchScript artifacts only have forward()')
+
+    with torch.inference_mode():
+        return model.embed(to_float(batch.to(device))).float().cpu()
+
+# At the image size in 'meta', which defaults to the one 'preprocessor' uses
+def get_pred(model: torch.nn.Module, img: Image, device: str, meta: ModelMeta | None = None) -> list[str]:
+    meta = meta or ModelMeta(labels, [threshold] * len(labels))
+    image_preprocessor = preprocessor if meta.image_size == preprocessor.size else ImagePreprocessor(meta.image_size)
+    transformed_img = image_preprocessor.to_uint8(img)
+
+    probs = get_probs(model, transformed_img.unsqueeze(0), device) # Have to insert a dimension at start representing batch size of 1
+
+    return meta.get_labels(probs[0])
@@ -0,0 +1,106 @@
+import json
+import sqlite3
+import numpy as np
+from pathlib import Path
+
+STATS_TABLE = 'label_stats'
+FETCH_SIZE = 10000
+
+class LabelStats:
+    def __init__(self, labels: list[str], count: int, co_occurrence: np.ndarray) -> None:
+        self.labels = labels
+        self.count = count
+        # co_occurrence[i, j] is the number of rows tagged with both i and j
+        self.co_occurrence = co_occurrence
+
+    @property
+    def positives(self) -> np.ndarray:
+        return np.diag(self.co_occurrence).copy()
+
+    @property
+    def negatives(self) -> np.ndarray:
+        return self.count - self.positives
+
+    @property
+    def prevalence(self) -> np.ndarray:
+        return self.positives / max(self.count, 1)
+
+    # negative/positive ratio per label for BCEWithLogitsLoss's pos_weight.
+    #   Labels without positives count as having one to avoid dividing by zero
+    def get_pos_weights(self) -> np.ndarray:
+        return self.negatives / np.maximum(self.positives, 1)
+
+def get_labels(connection: sqlite3.Connection, table: str) -> list[str]:
+    columns = connection.execute(f'PRAGMA table_info({table});').fetchall()
+    return [item[1] for item in columns if item[1] != 'app_id']
+
+# One pass over 'table', FETCH_SIZE rows at a time, so memory doesn't grow
+#   with the number of rows
+def compute_label_stats(connection: sqlite3.Connection, table: str) -> LabelStats:
+    labels = get_labels(connection, table)
+    cursor = connection.execute(f'SELECT {", ".join(labels)} FROM {table}')
+
+    count = 0
+    co_occurrence = np.zeros((len(labels), len(labels)), dtype=np.int64)
+
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if len(rows) == 0:
+            break
+
+        matrix = np.array(rows, dtype=np.int64)
+        co_occurrence += matrix.T @ matrix
+        count += len(rows)
+
+    return LabelStats(labels, count, co_occurrence)
+
+# Stores the stats in the database itself, so they are replaced in the same
+#   transaction as the split they describe
+def save_label_stats(connection: sqlite3.Connection, table: str, stats: LabelStats) -> None:
+    connection.execute(
+        f'''
+        CREATE TABLE IF NOT EXISTS {STATS_TABLE} (
+            table_name TEXT PRIMARY KEY,
+            labels TEXT,
+            count INTEGER,
+            co_occurrence BLOB
+        )
+        '''
+    )
+    connection.execute(
+        f'INSERT OR REPLACE INTO {STATS_TABLE} VALUES (?, ?, ?, ?)',
+        (table, json.dumps(stats.labels), stats.count, stats.co_occurrence.astype(np.int64).tobytes())
+    )
+
+def load_label_stats(connection: sqlite3.Connection, table: str) -> LabelStats | None:
+    table_exists = connection.execute(
+        f"SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name='{STATS_TABLE}')"
+    ).fetchone()[0]
+
+    if not table_exists:
+        return None
+
+    row = connection.execute(
+        f'SELECT labels, count, co_occurrence FROM {STATS_TABLE} WHERE table_name = ?', (table,)
+    ).fetchone()
+
+    if row is None:
+        return None
+
+    labels = json.loads(row[0])
+    co_occurrence = np.frombuffer(row[2], dtype=np.int64).reshape(len(labels), len(labels)).copy()
+    return LabelStats(labels, row[1], co_occurrence)
+
+# Cached stats for 'table', computed and stored on first use for splits
+#   made before the stats existed
+def get_label_stats(db: Path, table: str) -> LabelStats:
+    connection = sqlite3.connect(db)
+
+    stats = load_label_stats(connection, table)
+    if stats is None or stats.labels != get_labels(connection, table):
+        stats = compute_label_stats(connection, table)
+        with connection:
+            save_label_stats(connection, table, stats)
+
+    connection.close()
+    return stats
@@ -0,0 +1,118 @@
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+# Per-app progress, in order. 'failed' apps are retried on the next run
+#   until they reach MAX_ATTEMPTS
+LISTED = 'listed'
+PAGE_FETCHED = 'page_fetched'
+SCREENSHOT_DOWNLOADED = 'screenshot_downloaded'
+DB_WRITTEN = 'db_written'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = 3
+
+# Records what a scrape has already done so a restarted run can skip it:
+#   the parsed results of every search page fetched, and the status of each
+#   (app, tag) pair. Shared by all scraper threads
+class ScrapeManifest:
+    def __init__(self, path: Path) -> None:
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS search_pages (
+                tag TEXT,
+                start INTEGER,
+                games TEXT,
+                fetched_at REAL,
+                PRIMARY KEY (tag, start)
+            )
+            '''
+        )
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS apps (
+                app_id INTEGER,
+                tag TEXT,
+                name TEXT,
+                tag_ids TEXT,
+                status TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                updated_at REAL,
+                PRIMARY KEY (app_id, tag)
+            )
+            '''
+        )
+        self.connection.commit()
+
+    def get_search_page(self, tag: str, start: int) -> list[dict] | None:
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT games FROM search_pages WHERE tag = ? AND start = ?', (tag, start)
+            ).fetchone()
+
+        return None if row is None else json.loads(row[0])
+
+    def save_search_page(self, tag: str, start: int, games: list[dict]) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO search_pages VALUES (?, ?, ?, ?)',
+                (tag, start, json.dumps(games), time.time())
+            )
+
+    # Adds newly listed games. Apps already in the manifest keep their status
+    def add_listed(self, tag: str, games: list[dict]) -> None:
+        rows = [(int(game['app_id']), tag, game['name'], game['tag_ids'], LISTED, time.time())
+                for game in games if game['app_id'] is not None]
+
+        with self._lock, self.connection:
+            self.connection.executemany(
+                '''
+                INSERT OR IGNORE INTO apps (app_id, tag, name, tag_ids, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', rows
+            )
+
+    # Games for 'tag' that still need work, oldest first, at most 'limit'
+    def get_pending(self, tag: str, limit: int | None = None) -> list[dict]:
+        with self._lock:
+            rows = self.connection.execute(
+                f'''
+                SELECT app_id, name, tag_ids, status FROM apps
+                WHERE tag = ? AND status != ? AND NOT (status = ? AND attempts >= ?)
+                ORDER BY rowid
+                LIMIT ?
+                ''', (tag, DB_WRITTEN, FAILED, MAX_ATTEMPTS, -1 if limit is None else limit)
+            ).fetchall()
+
+        return [{'app_id': str(app_id), 'name': name, 'tag_ids': tag_ids, 'tag': tag, 'status': status}
+                for app_id, name, tag_ids, status in rows]
+
+    def mark(self, games: list[dict], status: str) -> None:
+        rows = [(status, time.time(), int(game['app_id']), game['tag']) for game in games]
+
+        with self._lock, self.connection:
+            self.connection.executemany(
+                'UPDATE apps SET status = ?, error = NULL, updated_at = ? WHERE app_id = ? AND tag = ?', rows
+            )
+
+    def mark_failed(self, game: dict, error: str) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                '''
+                UPDATE apps SET status = ?, error = ?, attempts = attempts + 1, updated_at = ?
+                WHERE app_id = ? AND tag = ?
+                ''', (FAILED, error, time.time(), int(game['app_id']), game['tag'])
+            )
+
+    def get_summary(self) -> dict[str, int]:
+        with self._lock:
+            rows = self.connection.execute('SELECT status, count(*) FROM apps GROUP BY status').fetchall()
+
+        return dict(rows)
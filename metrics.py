@@ -0,0 +1,122 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# In seconds, for anything from one stage of preprocessing to a whole request
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Histogram:
+    def __init__(self, buckets: list[float]) -> None:
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Last slot is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    # Upper bound of the bucket holding the q-th quantile, which is as
+    #   precise as a bucketed histogram can be
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + [float('inf')], self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            cumulative = []
+            seen = 0
+            for count in self.counts:
+                seen += count
+                cumulative.append(seen)
+
+            result = {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': {str(bound): total for bound, total in zip(self.buckets + ['+Inf'], cumulative)}
+            }
+
+        # JSON has no infinity, so quantiles past the last bucket become None
+        for name, q in [('p50', 0.5), ('p99', 0.99)]:
+            value = self.quantile(q)
+            result[name] = value if value != float('inf') else None
+
+        return result
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+# A histogram of durations per named stage, e.g. decode, resize or one block
+#   of the model
+class StageTimer:
+    def __init__(self, buckets: list[float] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.stages: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started_at)
+
+    def snapshot(self) -> dict:
+        return {stage: histogram.snapshot() for stage, histogram in list(self.stages.items())}
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels.items()]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+# Renders metrics in the Prometheus text exposition format. Each metric is
+#   (name, type, help, samples), where samples are (labels, value) pairs and
+#   the value of a 'histogram' is a Histogram
+def to_prometheus(metrics: list[tuple]) -> str:
+    lines = []
+
+    for name, metric_type, help_text, samples in metrics:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+        for labels, value in samples:
+            if metric_type != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {float(value)}')
+                continue
+
+            snapshot = value.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {snapshot["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {snapshot["count"]}')
+
+    return '\n'.join(lines) + '\n'
@@ -50,3 +50,7 @@ class MultiLabelClassifier(nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         return self.classifier(self.conv_block_3(self.conv_block_2(self.conv_block_1(x))))
+
+    # The 256-d hidden representation the last Linear maps to tag logits
+    def embed(self, x: torch.Tensor) -> torch.Tensor:
+        return self.classifier[:-1](self.conv_block_3(self.conv_block_2(self.conv_block_1(x))))
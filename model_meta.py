@@ -0,0 +1,82 @@
+import os
+import json
+from pathlib import Path
+from typing import Callable
+
+# Suffixes stripped from a model's file name to find its manifest, so an
+#   exported models/x.int8.ts shares models/x.meta.json with models/x.pt
+MODEL_SUFFIXES = ['.pt', '.pth', '.ts', '.int8']
+
+ARCHITECTURE = 'MultiLabelClassifier'
+HIDDEN_COUNT = 128
+IMAGE_SIZE = 256
+
+# Everything needed to serve a model besides its weights: the label
+#   vocabulary in output order, the per-tag thresholds tuned by trainer.py and
+#   the architecture parameters. Saved next to the weights as <name>.meta.json
+#   and small enough to read without importing torch
+class ModelMeta:
+    def __init__(self, labels: list[str], thresholds: list[float], hidden_count: int = HIDDEN_COUNT, image_size: int = IMAGE_SIZE) -> None:
+        self.labels = labels
+        self.thresholds = thresholds
+        self.hidden_count = hidden_count
+        self.image_size = image_size
+
+    # 'probs' is one image's row of sigmoid outputs
+    def get_labels(self, probs) -> list[str]:
+        return [label for prob, threshold, label in zip(probs.tolist(), self.thresholds, self.labels) if prob > threshold]
+
+    def get_probabilities(self, probs) -> dict[str, float]:
+        return {label: round(prob, 4) for prob, label in zip(probs.tolist(), self.labels)}
+
+    def to_json(self) -> dict:
+        return {
+            'labels': self.labels,
+            'thresholds': {label: round(threshold, 6) for label, threshold in zip(self.labels, self.thresholds)},
+            'architecture': {
+                'name': ARCHITECTURE,
+                'in_count': 3,
+                'hidden_count': self.hidden_count,
+                'out_count': len(self.labels)
+            },
+            'image_size': self.image_size
+        }
+
+def get_meta_path(model_save_path: Path) -> Path:
+    path = Path(model_save_path)
+    while path.suffix in MODEL_SUFFIXES:
+        path = path.with_suffix('')
+    return path.with_name(f'{path.name}.meta.json')
+
+# 'write' fills a temporary file that is then renamed over 'path'. A served
+#   model's weights are memory-mapped from its file, so rewriting it in place
+#   could hand a worker partial weights or kill it with SIGBUS; after a
+#   rename the old file stays intact for whoever still maps it
+def replace_file(path: Path, write: Callable[[Path], None]) -> None:
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_meta(model_save_path: Path, meta: ModelMeta) -> Path:
+    meta_path = get_meta_path(model_save_path)
+    replace_file(meta_path, lambda tmp_path: tmp_path.write_text(json.dumps(meta.to_json(), indent=4)))
+    return meta_path
+
+# Models saved before manifests existed get 'default_labels', the default
+#   architecture and 'default_threshold' for every tag. Manifests written
+#   before the architecture was recorded only lack those fields
+def load_meta(model_save_path: Path, default_labels: list[str], default_threshold: float = 0.5) -> ModelMeta:
+    meta_path = get_meta_path(model_save_path)
+    if not meta_path.exists():
+        return ModelMeta(default_labels, [default_threshold] * len(default_labels))
+
+    data = json.loads(meta_path.read_text())
+    labels = data.get('labels', default_labels)
+    tuned = data.get('thresholds', {})
+    architecture = data.get('architecture', {})
+
+    return ModelMeta(labels,
+                     [tuned.get(label, default_threshold) for label in labels],
+                     hidden_count=architecture.get('hidden_count', HIDDEN_COUNT),
+                     image_size=data.get('image_size', IMAGE_SIZE))
@@ -0,0 +1,187 @@
+import json
+import time
+import zlib
+import threading
+import torch
+import inference
+from pathlib import Path
+from metrics import Histogram, StageTimer, LATENCY_BUCKETS
+from profiling import time_modules
+from model_meta import ModelMeta
+from prediction_cache import get_model_version
+from preprocessing import ImagePreprocessor
+
+# Changes when a model file is replaced or rewritten, without hashing it on
+#   every poll. None if it doesn't exist
+def get_file_state(path: Path) -> tuple | None:
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# One loaded model file with its manifest, preprocessing and latency figures
+class ModelVersion:
+    def __init__(self, path: Path, device: str) -> None:
+        self.path = Path(path)
+        self.device = device
+        self.file_state = get_file_state(path)
+        self.version = get_model_version(path)
+        self.meta: ModelMeta = inference.load_meta(path)
+        self.model = inference.load_model(path, device, self.meta)
+        self.preprocessor = ImagePreprocessor(self.meta.image_size)
+        self.loaded_at = time.time()
+        self.warmed_up = False
+
+        self.requests = 0
+        self.forward_hist = Histogram(LATENCY_BUCKETS) # Per batch
+        self.latency_hist = Histogram(LATENCY_BUCKETS) # Per uncached request, decoding included
+        self.stage_timer = StageTimer() # Per block of the model, from the first request on
+
+    def get_probs(self, batch: torch.Tensor) -> torch.Tensor:
+        started_at = time.perf_counter()
+        probs = inference.get_probs(self.model, batch, self.device)
+        self.forward_hist.observe(time.perf_counter() - started_at)
+        return probs
+
+    # One forward pass allocates the activations and picks the kernels, so
+    #   the first request doesn't pay for any of it
+    def warm_up(self) -> None:
+        size = self.meta.image_size
+        inference.get_probs(self.model, torch.zeros((1, 3, size, size), dtype=torch.uint8), self.device)
+        time_modules(self.model, self.stage_timer)
+        self.warmed_up = True
+
+    def stats(self) -> dict:
+        return {
+            'path': str(self.path),
+            'model_version': self.version,
+            'loaded_at': self.loaded_at,
+            'requests': self.requests,
+            'forward_seconds': self.forward_hist.snapshot(),
+            'latency_seconds': self.latency_hist.snapshot(),
+            'stage_seconds': self.stage_timer.snapshot()
+        }
+
+# What is being served: every request goes to 'live' except 'canary_percent'
+#   of them, which go to 'candidate' when there is one. Replaced as a whole,
+#   so a request never sees half of a swap
+class Routes:
+    def __init__(self, live: ModelVersion, candidate: ModelVersion | None = None, canary_percent: float = 0) -> None:
+        self.live = live
+        self.candidate = candidate
+        self.canary_percent = canary_percent if candidate is not None else 0
+
+    def get_versions(self) -> list[ModelVersion]:
+        return [self.live] + ([self.candidate] if self.candidate is not None else [])
+
+    # By a checksum of the upload rather than at random, so the same image
+    #   always gets the same model (and the same cache entry)
+    def route(self, contents: bytes) -> ModelVersion:
+        if self.canary_percent > 0 and zlib.crc32(contents) % 10000 < self.canary_percent * 100:
+            return self.candidate
+        return self.live
+
+# Loads the models named in a manifest, or 'default_path' when there is none,
+#   and swaps them in once they are warmed up. refresh() runs off the
+#   inference thread, so requests keep being served by the previous routes
+#   while a new version loads. The manifest, paths relative to its directory:
+#
+#   {"live": "d5000e30.pt", "candidate": "my_model.pt", "canary_percent": 10}
+#
+#   Promoting the candidate is rewriting the manifest with it as "live". A
+#   model file that is replaced is reloaded too. It has to be replaced by
+#   renaming a new file over it (as trainer.py and export.py do), never
+#   rewritten in place: the weights being served are memory-mapped from it
+class ModelRegistry:
+    def __init__(self, default_path: Path, device: str, manifest_path: Path | None = None) -> None:
+        self.default_path = Path(default_path)
+        self.device = device
+        self.manifest_path = Path(manifest_path) if manifest_path is not None else None
+
+        self.routes: Routes | None = None
+        self.swaps = 0
+        self.last_error: str | None = None
+        self.failed: dict[tuple, str] = {} # (path, file state) -> error, so a bad file isn't retried until it changes. Only paths in the manifest are kept
+        self._lock = threading.Lock()
+
+    def read_manifest(self) -> tuple[Path, Path | None, float]:
+        if self.manifest_path is None or not self.manifest_path.exists():
+            return (self.default_path, None, 0)
+
+        data = json.loads(self.manifest_path.read_text())
+        directory = self.manifest_path.parent
+        candidate = data.get('candidate')
+
+        return (directory/data['live'],
+                directory/candidate if candidate else None,
+                float(data.get('canary_percent', 0)))
+
+    # Reuses a version that is already loaded from an unchanged file
+    def get_version(self, path: Path, warm_up: bool) -> ModelVersion:
+        file_state = get_file_state(path)
+        if file_state is None:
+            raise FileNotFoundError(f'{path} does not exist')
+
+        if self.routes is not None:
+            for version in self.routes.get_versions():
+                if version.path == path and version.file_state == file_state:
+                    if warm_up and not version.warmed_up:
+                        version.warm_up()
+                    return version
+
+        if (path, file_state) in self.failed:
+            raise RuntimeError(self.failed[(path, file_state)])
+
+        try:
+            version = ModelVersion(path, self.device)
+            if warm_up:
+                version.warm_up()
+        except Exception as e:
+            self.failed[(path, file_state)] = f'Could not load {path}: {e}'
+            raise RuntimeError(self.failed[(path, file_state)]) from e
+
+        print(f'✅ Loaded {path} (version {version.version})')
+        return version
+
+    # Returns whether the routes changed. A version that fails to load leaves
+    #   the current routes in place; without any, the error is raised
+    def refresh(self, warm_up: bool = True) -> bool:
+        with self._lock:
+            try:
+                live_path, candidate_path, canary_percent = self.read_manifest()
+                self.failed = {key: error for key, error in self.failed.items() if key[0] in (live_path, candidate_path)}
+                live = self.get_version(live_path, warm_up)
+                candidate = self.get_version(candidate_path, warm_up) if candidate_path is not None else None
+            except Exception as e:
+                if self.last_error != str(e):
+                    print(f'❌ {e}')
+                self.last_error = str(e)
+                if self.routes is None:
+                    raise
+                return False
+
+            self.last_error = None
+            routes = Routes(live, candidate, canary_percent)
+            if self.routes is not None and routes.get_versions() == self.routes.get_versions() \
+                    and routes.canary_percent == self.routes.canary_percent:
+                return False
+
+            if self.routes is not None:
+                self.swaps += 1
+            self.routes = routes # In-flight requests keep the versions they were routed to
+            return True
+
+    def route(self, contents: bytes) -> ModelVersion:
+        return self.routes.route(contents)
+
+    def stats(self) -> dict:
+        routes = self.routes
+        return {
+            'manifest': str(self.manifest_path) if self.manifest_path is not None else None,
+            'live': routes.live.stats() if routes is not None else None,
+            'candidate': routes.candidate.stats() if routes is not None and routes.candidate is not None else None,
+            'canary_percent': routes.canary_percent if routes is not None else 0,
+            'swaps': self.swaps,
+            'last_error': self.last_error
+        }
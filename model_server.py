@@ -1,53 +1,298 @@
+import time
+import_started_at = time.perf_counter() # The imports below are most of the startup time
+
+import os
 import torch
-import requests
-from torchvision import transforms
-from model import MultiLabelClassifier
+import asyncio
+import inference
 from pathlib import Path
 from PIL import Image
-from scraper import tag_dict
-from fastapi import FastAPI, UploadFile, File
-from io import BytesIO
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from metrics import Histogram, Counter, StageTimer, LATENCY_BUCKETS, to_prometheus
+from profiling import TraceCapture
+from embeddings import EmbeddingIndex, NPROBE
+from model_registry import ModelRegistry, ModelVersion
+from prediction_cache import PredictionCache
 
 model_path = Path('models/')
 model_name = 'd5000e30.pt'
 
-model_save_path = model_path/model_name
-
-num_labels = 12
-model = MultiLabelClassifier(in_count = 3, hidden_count = 128, out_count = num_labels)
+# GT_MODEL can point at another state dict or an exported .ts artifact. It
+#   is served unless a GT_REGISTRY manifest (models/registry.json by default)
+#   names the live model and a candidate; see model_registry.py. Both are
+#   checked every GT_REGISTRY_POLL seconds and changed models are loaded and
+#   swapped in without interrupting requests (0 turns watching off)
+model_save_path = Path(os.environ.get('GT_MODEL', model_path/model_name))
+REGISTRY_PATH = Path(os.environ.get('GT_REGISTRY', model_path/'registry.json'))
+REGISTRY_POLL = float(os.environ.get('GT_REGISTRY_POLL', 2))
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-model.load_state_dict(torch.load(model_save_path, 
-                                 map_location=torch.device(device)))
+registry = ModelRegistry(model_save_path, device, REGISTRY_PATH)
+
+# Set by load(), which runs in the background once the server is up. Until
+#   then /ready and the prediction endpoints answer 503
+prediction_cache = None
+ready_after: float | None = None # Seconds from import to ready
+load_error: str | None = None
+
+# Requests arriving within MAX_WAIT_MS of each other share one forward pass
+MAX_BATCH_SIZE = int(os.environ.get('GT_MAX_BATCH_SIZE', 32))
+MAX_WAIT_MS = float(os.environ.get('GT_MAX_WAIT_MS', 5))
+
+# Decoding runs on PREPROCESS_WORKERS threads and the forward pass on its own
+#   thread, both of which release the GIL. Requests beyond MAX_PENDING in
+#   flight are turned away with a 503 instead of queueing without bound
+PREPROCESS_WORKERS = int(os.environ.get('GT_PREPROCESS_WORKERS', os.cpu_count()))
+MAX_PENDING = int(os.environ.get('GT_MAX_PENDING', 256))
+TORCH_THREADS = int(os.environ.get('GT_TORCH_THREADS', 0)) # 0 keeps torch's default
+
+if TORCH_THREADS > 0:
+    torch.set_num_threads(TORCH_THREADS)
+
+# Repeated uploads of the same bytes skip decoding and the model. Entries are
+#   tied to the model file's content, so replacing it invalidates them.
+#   GT_CACHE_SIZE=0 disables the in-memory cache; GT_CACHE_PATH also keeps
+#   entries in SQLite across restarts; GT_CACHE_TTL=0 means no expiry
+CACHE_SIZE = int(os.environ.get('GT_CACHE_SIZE', 10000))
+CACHE_TTL = float(os.environ.get('GT_CACHE_TTL', 0))
+CACHE_PATH = os.environ.get('GT_CACHE_PATH')
+
+# Game embeddings built by embeddings.py, for /similar
+EMBEDDINGS_PATH = Path(os.environ.get('GT_EMBEDDINGS', 'embeddings'))
+embedding_index = None
+
+# GT_PROFILE_REQUESTS=N records a torch.profiler trace of the forward passes
+#   of the first N uncached requests to GT_PROFILE_PATH (by default
+#   traces/server-<pid>.json, one per worker process)
+PROFILE_REQUESTS = int(os.environ.get('GT_PROFILE_REQUESTS', 0))
+PROFILE_PATH = os.environ.get('GT_PROFILE_PATH')
+
+# Where a request's time goes before it reaches the model: reading the
+#   upload, opening, decoding and resizing the image and copying it into a
+#   tensor. The blocks of the model are timed per version
+stage_timer = StageTimer()
+decode_errors = Counter()
+trace_capture = None
+
+preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+inference_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+# Models are loaded and warmed up on their own thread, so the inference
+#   thread keeps serving the current ones meanwhile
+loader_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loader')
+cache_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache') # The prediction cache's SQLite reads and writes share one connection
+
+# uint8 until the batch reaches the model, a quarter of the bytes to stack
+def preprocess(version: ModelVersion, contents: bytes) -> torch.Tensor:
+    preprocessor = version.preprocessor
+
+    with stage_timer.time('open'):
+        img = preprocessor.open(contents)
+    with stage_timer.time('decode'):
+        img = preprocessor.decode_rgb(img)
+    with stage_timer.time('resize'):
+        img = preprocessor.resize(img)
+    with stage_timer.time('to_tensor'):
+        return preprocessor.to_tensor(img)
+
+# Runs on the inference thread, which is the one the profiler has to start on
+def forward(version: ModelVersion, batch: torch.Tensor) -> torch.Tensor:
+    with trace_capture.step(len(batch)):
+        return version.get_probs(batch)
 
 def get_pred(img: Image) -> list[str]:
-    data_transform = transforms.Compose([
-        transforms.Lambda(lambda img: img.convert("RGB")),
-        transforms.Resize(size=(256, 256)),
-        transforms.ToTensor()
-    ])
+    live = registry.routes.live
+    return inference.get_pred(live.model, img, device, live.meta)
+
+# Reads the manifests and memory-maps the weights. serve.py calls this once
+#   in the parent process before forking its workers, so they all share one copy
+def preload() -> None:
+    registry.refresh(warm_up=False)
+
+def update_cache_versions() -> None:
+    routes = registry.routes
+    prediction_cache.set_model_versions(routes.live.version, [version.version for version in routes.get_versions()[1:]])
+
+# Loads (or reuses the preloaded) models, warms them up and opens the
+#   prediction cache. Runs on the loader thread of every worker
+def load() -> None:
+    global prediction_cache, trace_capture, embedding_index
+
+    registry.refresh()
+
+    if (EMBEDDINGS_PATH/'meta.json').exists():
+        embedding_index = EmbeddingIndex(EMBEDDINGS_PATH)
+        print(f'✅ Loaded embeddings of {len(embedding_index)} games from {EMBEDDINGS_PATH}')
+
+    trace_capture = TraceCapture(PROFILE_REQUESTS, Path(PROFILE_PATH or f'traces/server-{os.getpid()}.json'))
+
+    prediction_cache = PredictionCache(registry.routes.live.version,
+                                       max_entries=CACHE_SIZE,
+                                       ttl=CACHE_TTL or None,
+                                       path=Path(CACHE_PATH) if CACHE_PATH else None)
+    update_cache_versions()
+
+async def warm_up() -> None:
+    global ready_after, load_error
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(loader_pool, load)
+    except Exception as e:
+        if load_error != str(e): # Retried by watch_models()
+            print(f'❌ {e}')
+        load_error = str(e)
+        return
+
+    ready_after = time.perf_counter() - import_started_at
+    print(f'✅ Serving {registry.routes.live.path}, ready {ready_after:.2f}s after import')
+
+# Picks up models written after startup. Until the first load succeeds
+#   warm_up() is retried instead
+async def watch_models() -> None:
+    loop = asyncio.get_running_loop()
+
+    while True:
+        await asyncio.sleep(REGISTRY_POLL)
+
+        if ready_after is None:
+            if load_error is not None:
+                await warm_up()
+            continue
+
+        if await loop.run_in_executor(loader_pool, registry.refresh):
+            update_cache_versions()
+            print(f'✅ Swapped models, now serving {registry.routes.live.path}'
+                  + (f' and {registry.routes.candidate.path} for {registry.routes.canary_percent}% of requests' if registry.routes.candidate else ''))
+
+def require_ready() -> None:
+    if ready_after is None:
+        raise HTTPException(status_code=503, detail=load_error or 'Model is still loading', headers={'Retry-After': '1'})
+
+class MicroBatcher:
+    def __init__(self, max_batch_size: int, max_wait: float) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+
+        self.batch_size_hist = Histogram([1, 2, 4, 8, 16, 32, 64, 128])
+        self.queue_latency_hist = Histogram(LATENCY_BUCKETS)
+
+    # Queues one transformed image and waits for its row of the output of
+    #   'version', the model the request was routed to
+    async def submit(self, version: ModelVersion, transformed_img: torch.Tensor) -> torch.Tensor:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((transformed_img, future, time.perf_counter(), version))
+        return await future
+
+    async def collect(self) -> list[tuple]:
+        batch = [await self.queue.get()]
 
-    transformed_img = data_transform(img)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
 
-    predicted_labels = []
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
 
-    model.eval()
-    with torch.inference_mode():
-        threshold = 0.5
-        pred_logits = model(transformed_img.unsqueeze(0)) # Have to insert a dimension at start representing batch size of 1
-        pred_labels = torch.round(torch.sigmoid(pred_logits))# >= threshold).int()
-        keys = list(tag_dict.keys())
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
 
-        pred_labels = pred_labels.flatten().tolist()
-        for pred, label in zip(pred_labels, keys):
-            if pred == 1:
-                predicted_labels.append(label)
+        return batch
 
-    return predicted_labels
+    async def run(self) -> None:
+        while True:
+            batch = await self.collect()
 
-app = FastAPI()
+            now = time.perf_counter()
+            for _, _, enqueued_at, _ in batch:
+                self.queue_latency_hist.observe(now - enqueued_at)
+            self.batch_size_hist.observe(len(batch))
+
+            # Only while a candidate is served does a batch hold more than one version
+            by_version = {}
+            for item in batch:
+                by_version.setdefault(item[3], []).append(item)
+
+            for version, items in by_version.items():
+                await self.run_batch(version, items)
+
+    async def run_batch(self, version: ModelVersion, items: list[tuple]) -> None:
+        try:
+            batch_input = torch.stack([item[0] for item in items])
+            probs = await asyncio.get_running_loop().run_in_executor(inference_pool, forward, version, batch_input)
+        except Exception as e:
+            for _, future, _, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _, _), row in zip(items, probs):
+            if not future.done(): # The client may have disconnected
+                future.set_result(row)
+
+    def stats(self) -> dict:
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batch_size': self.batch_size_hist.snapshot(),
+            'queue_latency_seconds': self.queue_latency_hist.snapshot()
+        }
+
+class AdmissionLimiter:
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self.rejected = 0
+
+    # Only touched from the event loop, so plain counters are enough. A
+    #   request bigger than the limit could never be admitted, so it's
+    #   refused outright instead of being told to retry
+    @contextmanager
+    def admit(self, count: int = 1):
+        if count > self.limit:
+            self.rejected += 1
+            raise HTTPException(status_code=413, detail=f'At most {self.limit} images per request')
+        if self.in_flight + count > self.limit:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail='Server is busy, try again later', headers={'Retry-After': '1'})
+
+        self.in_flight += count
+        try:
+            yield
+        finally:
+            self.in_flight -= count
+
+    def stats(self) -> dict:
+        return {
+            'max_pending': self.limit,
+            'in_flight': self.in_flight,
+            'rejected': self.rejected
+        }
+
+batcher = MicroBatcher(max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_MS / 1000)
+limiter = AdmissionLimiter(MAX_PENDING)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [asyncio.create_task(batcher.run()), asyncio.create_task(warm_up())]
+    if REGISTRY_POLL > 0:
+        tasks.append(asyncio.create_task(watch_models()))
+    yield
+    for task in tasks:
+        task.cancel()
+    preprocess_pool.shutdown(wait=False)
+    inference_pool.shutdown(wait=False)
+    loader_pool.shutdown(wait=False)
+    cache_pool.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -57,8 +302,154 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class DecodeError(Exception):
+    pass
+
+async def read_upload(img: UploadFile) -> bytes:
+    with stage_timer.time('read'):
+        return await img.read()
+
+# Routing and the cache key both hash the whole upload, so they run on a
+#   preprocessing thread rather than on the event loop
+def route_upload(contents: bytes) -> tuple[ModelVersion, str]:
+    version = registry.route(contents)
+    return (version, prediction_cache.get_key(contents, version.version))
+
+# Probabilities for one upload from the model it's routed to, skipping
+#   decoding and the model when the cache has them. Only the in-memory
+#   lookup runs on the event loop; the SQLite file is read and written on
+#   the cache thread
+async def get_upload_probs(contents: bytes) -> tuple[torch.Tensor, ModelVersion]:
+    loop = asyncio.get_running_loop()
+    version, key = await loop.run_in_executor(preprocess_pool, route_upload, contents)
+    version.requests += 1
+
+    probs = prediction_cache.get_from_memory(key)
+    if probs is None:
+        probs = await loop.run_in_executor(cache_pool, prediction_cache.load, key)
+    if probs is None:
+        started_at = time.perf_counter()
+        try:
+            transformed_img = await loop.run_in_executor(preprocess_pool, preprocess, version, contents)
+        except Exception as e:
+            decode_errors.inc()
+            raise DecodeError(e) from e
+        probs = await batcher.submit(version, transformed_img)
+        version.latency_hist.observe(time.perf_counter() - started_at)
+        await loop.run_in_executor(cache_pool, prediction_cache.put, key, probs)
+
+    return (probs, version)
+
 @app.post('/predict')
 async def predict(img: UploadFile = File(...)):
-    contents = await img.read()
-    img = Image.open(BytesIO(contents))
-    return {'tags': get_pred(img)}
+    require_ready()
+
+    with limiter.admit():
+        try:
+            probs, version = await get_upload_probs(await read_upload(img))
+        except DecodeError as e:
+            raise HTTPException(status_code=400, detail=f'Could not decode image: {e}')
+
+    return {'tags': version.meta.get_labels(probs), 'model_version': version.version}
+
+# Every image goes through the same micro-batcher as /predict, so a batch
+#   upload is split into (or merged with) forward passes of MAX_BATCH_SIZE.
+#   An image that can't be decoded gets an error entry instead of failing
+#   the whole request
+@app.post('/predict_batch')
+async def predict_batch(imgs: list[UploadFile] = File(...)):
+    require_ready()
+
+    async def tag_one(img: UploadFile) -> dict:
+        try:
+            probs, version = await get_upload_probs(await read_upload(img))
+        except DecodeError as e:
+            return {'filename': img.filename, 'error': f'Could not decode image: {e}'}
+
+        return {
+            'filename': img.filename,
+            'tags': version.meta.get_labels(probs),
+            'probabilities': version.meta.get_probabilities(probs),
+            'model_version': version.version
+        }
+
+    with limiter.admit(len(imgs)):
+        results = await asyncio.gather(*[tag_one(img) for img in imgs])
+
+    return {'results': results}
+
+# For the orchestrator: 200 only once the model is loaded and warmed up
+@app.get('/ready')
+async def ready():
+    require_ready()
+    routes = registry.routes
+    return {
+        'model': str(routes.live.path),
+        'model_version': routes.live.version,
+        'candidate_version': routes.candidate.version if routes.candidate is not None else None,
+        'import_to_ready_seconds': ready_after
+    }
+
+# The live and candidate models with their request counts and latencies, to
+#   compare before promoting the candidate
+@app.get('/models')
+async def models():
+    return registry.stats()
+
+# The k games whose screenshots are closest to app_id's in the model's hidden
+#   representation, by cosine similarity. A plain def, so FastAPI scores on
+#   its thread pool instead of the event loop
+@app.get('/similar')
+def similar(app_id: int, k: int = Query(10, ge=1, le=1000), nprobe: int = Query(NPROBE, ge=1, le=1000)):
+    require_ready()
+    if embedding_index is None:
+        raise HTTPException(status_code=503, detail=f'No embeddings in {EMBEDDINGS_PATH}, build them with embeddings.py')
+    if app_id not in embedding_index.rows:
+        raise HTTPException(status_code=404, detail=f'No embedding for app_id {app_id}')
+
+    return {
+        'app_id': app_id,
+        'similar': [{'app_id': other, 'score': round(score, 4)} for other, score in embedding_index.similar(app_id, k, nprobe)]
+    }
+
+@app.get('/stats')
+async def stats():
+    return {
+        **batcher.stats(),
+        'stage_seconds': stage_timer.snapshot(),
+        'admission': limiter.stats(),
+        'prediction_cache': prediction_cache.stats() if prediction_cache is not None else None,
+        'import_to_ready_seconds': ready_after,
+        'pid': os.getpid(),
+        'torch_threads': torch.get_num_threads()
+    }
+
+# The same figures as /stats and /models in the Prometheus text format. Each
+#   worker process of serve.py answers with its own
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    routes = registry.routes
+    versions = routes.get_versions() if routes is not None else []
+    cache = prediction_cache.stats() if prediction_cache is not None else {}
+
+    return to_prometheus([
+        ('gt_ready', 'gauge', 'Whether a model is loaded and warmed up', [({}, ready_after is not None)]),
+        ('gt_requests_total', 'counter', 'Images routed to each model version, cached or not',
+         [({'model_version': version.version}, version.requests) for version in versions]),
+        ('gt_request_seconds', 'histogram', 'Time from decoding an uncached image to its result',
+         [({'model_version': version.version}, version.latency_hist) for version in versions]),
+        ('gt_stage_seconds', 'histogram', 'Time spent in each stage before the model',
+         [({'stage': stage}, histogram) for stage, histogram in list(stage_timer.stages.items())]),
+        ('gt_model_stage_seconds', 'histogram', 'Time spent in each block of the model per batch',
+         [({'model_version': version.version, 'stage': stage}, histogram)
+          for version in versions for stage, histogram in list(version.stage_timer.stages.items())]),
+        ('gt_forward_seconds', 'histogram', 'Forward pass time per batch',
+         [({'model_version': version.version}, version.forward_hist) for version in versions]),
+        ('gt_queue_seconds', 'histogram', 'Time an image waits for its batch', [({}, batcher.queue_latency_hist)]),
+        ('gt_batch_size', 'histogram', 'Images per forward pass', [({}, batcher.batch_size_hist)]),
+        ('gt_cache_lookups_total', 'counter', 'Prediction cache lookups by result',
+         [({'result': result}, cache.get(key, 0)) for result, key in [('hit', 'hits'), ('disk_hit', 'disk_hits'), ('miss', 'misses')]]),
+        ('gt_decode_errors_total', 'counter', 'Uploads that could not be decoded', [({}, decode_errors.value)]),
+        ('gt_rejected_total', 'counter', 'Requests turned away while MAX_PENDING were in flight', [({}, limiter.rejected)]),
+        ('gt_in_flight', 'gauge', 'Images being processed', [({}, limiter.in_flight)])
+    ])
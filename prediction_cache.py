@@ -0,0 +1,194 @@
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import torch
+from pathlib import Path
+from collections import OrderedDict
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Identifies the weights a prediction came from by their content, so replacing
+#   the model file (even under the same name) invalidates every cached entry
+def get_model_version(model_save_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(model_save_path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+# Sigmoid outputs of uploads the model has already seen, keyed by a hash of
+#   the uploaded bytes and the model version. Probabilities rather than tags
+#   are cached, so thresholds can change without invalidating anything.
+#   The most recently used 'max_entries' live in memory; with 'path', every
+#   entry is also kept in SQLite (up to 'max_disk_entries') so it survives
+#   restarts and is shared by processes using the same file. Entries older
+#   than 'ttl' seconds count as misses. The memory and the SQLite file have
+#   separate locks, so a lookup in memory never waits on disk I/O
+class PredictionCache:
+    def __init__(self, model_version: str, max_entries: int = 10000, ttl: float | None = None,
+                 path: Path | None = None, max_disk_entries: int = 1000000) -> None:
+        self.model_version = model_version
+        self.other_versions: list[str] = []
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.entries: OrderedDict[str, tuple[torch.Tensor, float]] = OrderedDict()
+
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.connection = None
+        self.disk_entries = 0
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS predictions (
+                    key TEXT PRIMARY KEY,
+                    probs BLOB,
+                    created_at REAL,
+                    accessed_at REAL
+                )
+                '''
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_accessed_at ON predictions(accessed_at)')
+            self.connection.commit()
+            self.disk_entries = self.connection.execute('SELECT count(*) FROM predictions').fetchone()[0]
+
+    # A candidate served next to the live model passes its own version
+    def get_key(self, contents: bytes, model_version: str | None = None) -> str:
+        return f'{model_version or self.model_version}:{hashlib.sha256(contents).hexdigest()}'
+
+    # After the registry swaps models. Rows of 'other_versions' (a candidate
+    #   being compared against the live model) survive eviction as well
+    def set_model_versions(self, model_version: str, other_versions: list[str]) -> None:
+        with self._lock:
+            self.model_version = model_version
+            self.other_versions = other_versions
+
+    def is_fresh(self, created_at: float, now: float) -> bool:
+        return self.ttl is None or now - created_at <= self.ttl
+
+    def get(self, key: str) -> torch.Tensor | None:
+        probs = self.get_from_memory(key)
+        if probs is None:
+            probs = self.load(key)
+        return probs
+
+    # The in-memory half of get(), cheap enough to run on an event loop. A
+    #   miss isn't counted yet, load() is expected to follow it
+    def get_from_memory(self, key: str) -> torch.Tensor | None:
+        now = time.time()
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or not self.is_fresh(entry[1], now):
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # The disk half of get(), for a key get_from_memory() didn't have
+    def load(self, key: str) -> torch.Tensor | None:
+        now = time.time()
+        probs = self.get_from_disk(key, now)
+
+        with self._lock:
+            if probs is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            self.remember(key, probs, now)
+            return probs
+
+    def get_from_disk(self, key: str, now: float) -> torch.Tensor | None:
+        if self.connection is None:
+            return None
+
+        with self._disk_lock:
+            row = self.connection.execute('SELECT probs, created_at FROM predictions WHERE key = ?', (key,)).fetchone()
+            if row is None or not self.is_fresh(row[1], now):
+                return None
+
+            with self.connection:
+                self.connection.execute('UPDATE predictions SET accessed_at = ? WHERE key = ?', (now, key))
+
+        return torch.from_numpy(np.frombuffer(row[0], dtype=np.float32).copy())
+
+    # 'probs' is often a row of a batched output, so it's copied rather than
+    #   keeping the whole batch alive
+    def put(self, key: str, probs: torch.Tensor) -> None:
+        probs = probs.detach().to('cpu', torch.float32, copy=True)
+        now = time.time()
+
+        with self._lock:
+            self.remember(key, probs, now)
+
+        if self.connection is not None:
+            with self._disk_lock:
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                            (key, probs.numpy().tobytes(), now, now))
+
+                # Only misses are put, so this is a new row unless another
+                #   process added it meanwhile; evict_from_disk recounts
+                self.disk_entries += 1
+                if self.disk_entries > self.max_disk_entries:
+                    self.evict_from_disk()
+
+    def remember(self, key: str, probs: torch.Tensor, created_at: float) -> None:
+        if self.max_entries <= 0:
+            return
+
+        self.entries[key] = (probs, created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Drops rows left by older models, then least recently used ones until
+    #   the table is at 90% of its limit, so this doesn't run on every put.
+    #   Called with the disk lock held
+    def evict_from_disk(self) -> None:
+        with self._lock:
+            versions = [self.model_version, *self.other_versions]
+        conditions = ' AND '.join(['key NOT LIKE ?'] * len(versions))
+
+        with self.connection:
+            self.connection.execute(f'DELETE FROM predictions WHERE {conditions}', [f'{version}:%' for version in versions])
+            self.connection.execute(
+                '''DELETE FROM predictions WHERE key IN (
+                       SELECT key FROM predictions ORDER BY accessed_at
+                       LIMIT max(0, (SELECT count(*) FROM predictions) - ?)
+                   )
+                ''',
+                (int(self.max_disk_entries * 0.9),)
+            )
+
+        self.disk_entries = self.connection.execute('SELECT count(*) FROM predictions').fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'model_version': self.model_version,
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl,
+            'on_disk': self.connection is not None,
+            'disk_entries': self.disk_entries,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups > 0 else None
+        }
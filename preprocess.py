@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from pathlib import Path
+from torch.utils.data import DataLoader, Subset
+from dataset import CustomDataset
+from preprocessing import ImagePreprocessor, DECODER
+
+# ---- Configuration ----
+DATA_PATH = Path('data')
+DB_FILE = 'tag_info.db'
+SHARD_DIR = 'shards'
+IMAGE_SIZE = 256
+TABLES = ['train', 'validation', 'test']
+
+# ------------------------
+
+# Same decode and resize steps as the trainer's data_transform, which also
+#   stops at a uint8 CHW tensor, so the result can be stored as-is
+def get_shard_transform(size: int):
+    return ImagePreprocessor(size).to_uint8
+
+# Hash of everything that affects the contents of a shard: the rows of the
+#   split and the transform parameters
+def get_cache_key(app_ids: np.ndarray, labels: np.ndarray, size: int) -> str:
+    h = hashlib.sha256()
+    h.update(app_ids.tobytes())
+    h.update(labels.tobytes())
+    h.update(json.dumps({'size': size, 'mode': 'RGB', 'dtype': 'uint8', 'decoder': DECODER}).encode())
+    return h.hexdigest()[:16]
+
+# Maps app_id -> (images array, row) for every shard already on disk that was
+#   built with the same image size and decoder, so unchanged images can be
+#   copied instead of decoded again
+def get_reusable_rows(shard_root: Path, size: int) -> dict:
+    reusable = {}
+
+    if not shard_root.exists():
+        return reusable
+
+    for shard in shard_root.iterdir():
+        meta_path = shard/'meta.json'
+        if not meta_path.exists():
+            continue
+
+        meta = json.loads(meta_path.read_text())
+        if meta['size'] != size or meta.get('decoder') != DECODER:
+            continue
+
+        images = np.load(shard/'images.npy', mmap_mode='r')
+        app_ids = np.load(shard/'app_ids.npy')
+
+        for row, app_id in enumerate(app_ids.tolist()):
+            reusable[app_id] = (images, row)
+
+    return reusable
+
+# Builds (or finds) the shard for 'table' and returns its directory
+def build_shards(data_path: Path = DATA_PATH, db_file: str = DB_FILE, table: str = 'train', size: int = IMAGE_SIZE, num_workers: int | None = None) -> Path:
+    dataset = CustomDataset(data_path=data_path,
+                            db_file=db_file,
+                            table=table,
+                            transform=get_shard_transform(size))
+
+    key = get_cache_key(dataset.app_ids, dataset.labels, size)
+    shard_root = data_path/SHARD_DIR
+    shard_path = shard_root/f'{table}-{key}'
+
+    if (shard_path/'meta.json').exists():
+        return shard_path
+
+    reusable = get_reusable_rows(shard_root, size)
+
+    tmp_path = shard_root/f'.{table}-{key}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    images = np.lib.format.open_memmap(tmp_path/'images.npy',
+                                       mode='w+',
+                                       dtype=np.uint8,
+                                       shape=(len(dataset), 3, size, size))
+
+    to_decode = []
+    for index, app_id in enumerate(dataset.app_ids.tolist()):
+        if app_id in reusable:
+            source, row = reusable[app_id]
+            images[index] = source[row]
+        else:
+            to_decode.append(index)
+
+    print(f'{table}: reusing {len(dataset) - len(to_decode)} images, decoding {len(to_decode)}')
+
+    if len(to_decode) > 0:
+        loader = DataLoader(dataset=Subset(dataset, to_decode),
+                            batch_size=64,
+                            num_workers=os.cpu_count() if num_workers is None else num_workers)
+
+        position = 0
+        for batch, _ in loader:
+            indices = to_decode[position:position + len(batch)]
+            images[indices] = batch.numpy()
+            position += len(batch)
+
+    images.flush()
+    del images
+
+    np.save(tmp_path/'app_ids.npy', dataset.app_ids)
+    np.save(tmp_path/'labels.npy', dataset.labels)
+    (tmp_path/'meta.json').write_text(json.dumps({
+        'table': table,
+        'size': size,
+        'decoder': DECODER,
+        'classes': dataset.classes,
+        'count': len(dataset)
+    }))
+
+    # Publish the new shard, then drop stale ones for the same table
+    tmp_path.rename(shard_path)
+    for shard in shard_root.glob(f'{table}-*'):
+        if shard != shard_path:
+            shutil.rmtree(shard, ignore_errors=True)
+
+    return shard_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Decodes and resizes the train/test images once into memory-mappable shards')
+    parser.add_argument('-s', '--size', type=int, help='Side length the images are resized to', default=IMAGE_SIZE)
+    args = parser.parse_args()
+
+    for table in TABLES:
+        shard_path = build_shards(table=table, size=args.size)
+        print(f'{table}: {shard_path}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+from torch.nn import functional
+
+IMAGE_SIZE = 256
+
+# Bumped whenever decoding changes the pixels it produces, so shards built by
+#   an older decoder aren't reused
+DECODER = 'draft-bilinear'
+
+# uint8 images scaled to [0, 1] the way ToTensor does; anything else passes
+#   through unchanged
+def to_float(inputs: torch.Tensor) -> torch.Tensor:
+    if inputs.dtype == torch.uint8:
+        return inputs.float().div_(255)
+    return inputs
+
+# Decodes and resizes images to 'size' x 'size' RGB. Steam screenshots are
+#   mostly 1920x1080 JPEGs; draft mode lets libjpeg decode them directly at
+#   1/2, 1/4 or 1/8 scale (the smallest that is still at least 'size' on each
+#   side), which skips most of the decoding work before the final resize.
+#   One instance is shared by the trainer, the server and the shard builder
+class ImagePreprocessor:
+    def __init__(self, size: int = IMAGE_SIZE) -> None:
+        self.size = size
+
+    # A float CHW tensor in [0, 1], a drop-in for the old
+    #   Compose([convert('RGB'), Resize, ToTensor])
+    def __call__(self, source) -> torch.Tensor:
+        return to_float(self.to_uint8(source))
+
+    # A uint8 CHW tensor from encoded bytes, a path, a PIL image, or a raw
+    #   RGB tensor/array (CHW or HWC; uint8, or float in [0, 1]). With 'out',
+    #   the pixels are written into that preallocated tensor, e.g. a slot of
+    #   a batch
+    def to_uint8(self, source, out: torch.Tensor | None = None) -> torch.Tensor:
+        if isinstance(source, (torch.Tensor, np.ndarray)):
+            return self.from_raw(torch.as_tensor(source), out)
+
+        return self.to_tensor(self.decode(self.open(source)), out)
+
+    def open(self, source) -> Image.Image:
+        if isinstance(source, Image.Image):
+            return source
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return Image.open(BytesIO(source))
+        return Image.open(Path(source))
+
+    # decode_rgb, resize and to_tensor are the stages of to_uint8, separate
+    #   so the server can time each of them
+    def decode(self, img: Image.Image) -> Image.Image:
+        return self.resize(self.decode_rgb(img))
+
+    def decode_rgb(self, img: Image.Image) -> Image.Image:
+        if img.format == 'JPEG':
+            img.draft('RGB', (self.size, self.size))
+        return img.convert('RGB')
+
+    def resize(self, img: Image.Image) -> Image.Image:
+        if img.size != (self.size, self.size):
+            img = img.resize((self.size, self.size), Image.Resampling.BILINEAR)
+        return img
+
+    def to_tensor(self, img: Image.Image, out: torch.Tensor | None = None) -> torch.Tensor:
+        if out is None:
+            out = torch.empty((3, self.size, self.size), dtype=torch.uint8)
+
+        # A single copy from PIL's buffer straight into the CHW layout
+        np.copyto(out.numpy().transpose(1, 2, 0), np.asarray(img))
+        return out
+
+    def from_raw(self, tensor: torch.Tensor, out: torch.Tensor | None = None) -> torch.Tensor:
+        if tensor.ndim != 3:
+            raise ValueError(f'Expected a 3-dimensional image, got shape {tuple(tensor.shape)}')
+        if tensor.shape[0] != 3 and tensor.shape[-1] == 3:
+            tensor = tensor.permute(2, 0, 1)
+        if tensor.shape[0] != 3:
+            raise ValueError(f'Expected an RGB image, got shape {tuple(tensor.shape)}')
+
+        if tensor.dtype != torch.uint8:
+            tensor = (tensor.float() * 255).round_().clamp_(0, 255).to(torch.uint8)
+
+        if tensor.shape[1:] != (self.size, self.size):
+            resized = functional.interpolate(tensor.unsqueeze(0).float(), size=(self.size, self.size),
+                                             mode='bilinear', antialias=True, align_corners=False)
+            tensor = resized.squeeze(0).round_().clamp_(0, 255).to(torch.uint8)
+
+        if out is None:
+            return tensor.contiguous()
+        return out.copy_(tensor)
@@ -0,0 +1,73 @@
+import time
+import torch
+from pathlib import Path
+from contextlib import contextmanager
+from metrics import StageTimer
+
+# Times the forward pass of each top-level block of the model (conv_block_1
+#   to 3 and the classifier) into 'timer'. On CUDA this is the time to queue
+#   the kernels rather than to run them. TorchScript artifacts have no hooks
+#   and are only timed as a whole
+def time_modules(model: torch.nn.Module, timer: StageTimer) -> list:
+    if isinstance(model, torch.jit.ScriptModule):
+        return []
+
+    handles = []
+    for name, module in model.named_children():
+        started_at = {}
+
+        def before(module, inputs, started_at=started_at):
+            started_at['time'] = time.perf_counter()
+
+        def after(module, inputs, output, name=name, started_at=started_at):
+            timer.observe(name, time.perf_counter() - started_at.pop('time'))
+
+        handles.append(module.register_forward_pre_hook(before))
+        handles.append(module.register_forward_hook(after))
+
+    return handles
+
+# Records a torch.profiler trace of 'steps' units of work (training steps,
+#   requests) after skipping the first 'skip', and writes it to 'path' for
+#   chrome://tracing or Perfetto. The profiler only sees the thread it was
+#   started on, so every step has to run on the same thread
+class TraceCapture:
+    def __init__(self, steps: int, path: Path, skip: int = 0) -> None:
+        self.steps = steps
+        self.path = Path(path)
+        self.skip = skip
+
+        self.taken = 0
+        self.profiler = None
+        self.done = steps <= 0
+
+    @contextmanager
+    def step(self, count: int = 1):
+        if self.done or self.skip > 0:
+            self.skip = max(0, self.skip - count)
+            yield
+            return
+
+        if self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, with_stack=False)
+            self.profiler.__enter__()
+
+        try:
+            yield
+        finally:
+            self.taken += count
+            if self.taken >= self.steps:
+                self.stop()
+
+    def stop(self) -> None:
+        if self.profiler is None or self.done:
+            return
+
+        self.profiler.__exit__(None, None, None)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.profiler.export_chrome_trace(str(self.path))
+        self.done = True
+        print(f'✅ Wrote a profiler trace of {self.taken} steps to {self.path}')
@@ -1,14 +1,21 @@
 import os
 import math
 import random
-import sqlite3
 import requests
+import shutil
+import hashlib
 import argparse
+import threading
 import subprocess
 from pathlib import Path
-from functools import partial
+from functools import lru_cache
+from PIL import Image
 from bs4 import BeautifulSoup
-from multiprocessing import Pool
+from tags import tag_dict
+from fetcher import Fetcher, ResponseCache
+from tag_db import TagWriter
+from manifest import ScrapeManifest, PAGE_FETCHED, SCREENSHOT_DOWNLOADED, DB_WRITTEN
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class DataPoint:
     def __init__(self, app_id, title, screenshot_url, tags):
@@ -17,29 +24,47 @@ class DataPoint:
         self.screenshot_url = screenshot_url
         self.tags = tags
 
-tag_dict = {
-        'Platformer': 1625,
-        'Action': 19,
-        'Casual': 597,
-        'Adventure': 21,
-        'TwoD': 3871,
-        'ThreeD': 4191,
-        'Simulation': 599,
-        'Strategy': 9,
-        'RPG': 122,
-        'Puzzle': 1664,
-        'Horror': 1667,
-        'Sports': 701
-}
+# Base URLs, overridable so the scraper can run against a local stub server
+STORE_URL = os.environ.get('GT_STORE_URL', 'https://store.steampowered.com')
+API_URL = os.environ.get('GT_API_URL', 'https://api.steampowered.com')
+
+# How long cached responses stay fresh, in seconds
+APP_LIST_TTL = 24 * 60 * 60
+SEARCH_TTL = 24 * 60 * 60
+STORE_PAGE_TTL = 7 * 24 * 60 * 60
+APP_DETAILS_TTL = 7 * 24 * 60 * 60
+
+# Apps whose parsed store page and appdetails entry are kept in memory for
+#   the run, so the validity checks of an app fetch and parse each only once
+#   even without the response cache
+APP_MEMO_SIZE = 1024
+
+# Screenshots are streamed in CHUNK_SIZE pieces and stored once per content
+#   hash under BLOB_DIR. SCREENSHOT_SIZE, when set, re-encodes them at that
+#   square resolution (the trainer's input size) as they are downloaded
+CHUNK_SIZE = 64 * 1024
+BLOB_DIR = 'blobs'
+SCREENSHOT_SIZE: int | None = None
+
+# Shared by every scraping thread. Replaced in __main__ when limits are
+#   passed on the command line
+fetcher = Fetcher()
+
+# Single writer for data/tag_info.db, started in __main__
+writer: TagWriter | None = None
+
+# Progress of the current scrape, used to resume it. Optional
+manifest: ScrapeManifest | None = None
 
 # <<< Getters
 
 # Return Type: list of dictionaries containing 2 string keys: 'appid' and 'name'
 #   'appid': int
 #   'name': str
+@lru_cache(maxsize=1)
 def get_all_steam_apps() -> list[dict]:
-    url = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
-    response = requests.get(url, timeout=10)
+    url = f"{API_URL}/ISteamApps/GetAppList/v2/"
+    response = fetcher.get(url, ttl=APP_LIST_TTL)
     data = response.json()
     return data['applist']['apps']
 
@@ -53,28 +78,38 @@ def get_games_by_tag(tag: str, count: int) -> list[dict]:
 
     for fetch in range(num_fetch):
         start = (fetch * 100) + 1
-        url = f'https://store.steampowered.com/search/results/?query=&start={start}&count={count}&dynamic_data=&force_infinite=1&tags={tag_id}&supportedlang=english&ndl=1&snr=1_7_7_240_7&infinite=1'
 
-        response = requests.get(url, timeout=10).json()
+        # Pages fetched by an earlier run are read back from the manifest
+        page_games = manifest.get_search_page(tag, start) if manifest is not None else None
+
+        if page_games is None:
+            page_games = []
+            url = f'{STORE_URL}/search/results/?query=&start={start}&count={count}&dynamic_data=&force_infinite=1&tags={tag_id}&supportedlang=english&ndl=1&snr=1_7_7_240_7&infinite=1'
 
-        soup = BeautifulSoup(response['results_html'], 'html.parser')
-        all_games_html = soup.find_all('a', class_='search_result_row ds_collapse_flag')
+            response = fetcher.get(url, ttl=SEARCH_TTL).json()
 
-        for item in all_games_html:
-            name = item.find('span', class_='title').text
-            app_id = item.get('data-ds-appid')
-            tag_ids = item.get('data-ds-tagids')
-            if tag_ids is None:
-                continue
+            soup = BeautifulSoup(response['results_html'], 'html.parser')
+            all_games_html = soup.find_all('a', class_='search_result_row ds_collapse_flag')
 
-            tag_ids = f'{tag_ids[:-1]},{tag_dict[tag]}]' # This is to ensure that the the tag list contains the tag passed in to this method
-                                                         # It will cause duplicate tag ids in some cases
-            result.append({'name': name, 'app_id': app_id, 'tag_ids': tag_ids})
-            if len(result) == count:
-                break
+            for item in all_games_html:
+                name = item.find('span', class_='title').text
+                app_id = item.get('data-ds-appid')
+                tag_ids = item.get('data-ds-tagids')
+                if tag_ids is None:
+                    continue
 
+                tag_ids = f'{tag_ids[:-1]},{tag_dict[tag]}]' # This is to ensure that the the tag list contains the tag passed in to this method
+                                                             # It will cause duplicate tag ids in some cases
+                page_games.append({'name': name, 'app_id': app_id, 'tag_ids': tag_ids})
 
-    return result
+            if manifest is not None:
+                manifest.save_search_page(tag, start, page_games)
+
+        result.extend(page_games)
+        if len(result) >= count:
+            break
+
+    return result[:count]
 
 # Returns: A 'count'-sized list of dictionary items describing a game
 def get_random_steam_games(count:int = 1) -> list[dict]:
@@ -93,27 +128,43 @@ def get_random_steam_games(count:int = 1) -> list[dict]:
 
 # Returns a string url of the first screenshot on an app's store page
 def get_ss_url(app_id: int) -> str:
-    response = get_store_response(app_id)
-
-    soup = BeautifulSoup(response.text, 'html.parser')
+    page = get_store_page(app_id)
 
-    # Find all screenshot thumbnails
-    screenshots = soup.find_all("a", {"class": "highlight_screenshot_link"})
-    if len(screenshots) == 0:
+    if len(page.screenshot_urls) == 0:
         raise Exception("No screenshots found on the store page.")
 
-    # Get the href from the first screenshot
-    first_screenshot_url = screenshots[0].get("href")
-    
-    return first_screenshot_url.split('?')[0]  # Remove any trailing query parameters
+    return page.screenshot_urls[0].split('?')[0]  # Remove any trailing query parameters
+
+# What the validity checks need from an app's store page, parsed once
+#   instead of keeping the whole response around
+class StorePage:
+    def __init__(self, response: requests.Response) -> None:
+        self.status_code = response.status_code
+        self.url = response.url
+
+        text = response.text.lower()
+        self.not_found = "app doesn't exist" in text or "application not found" in text
+
+        soup = BeautifulSoup(response.text, 'html.parser')
+
+        # All screenshot thumbnails
+        screenshots = soup.find_all("a", {"class": "highlight_screenshot_link"})
+        self.screenshot_urls = [screenshot.get("href") for screenshot in screenshots]
+
+        # None when the page has no tag list
+        self.tags = None
+        genres_container = soup.find("div", {"id": "genresAndManufacturer", "class": "details_block"})
+        if genres_container is not None and genres_container.find('span') is not None:
+            self.tags = [link.text.lower() for link in genres_container.find('span').find_all('a')]
+
+@lru_cache(maxsize=APP_MEMO_SIZE)
+def get_store_page(app_id: int) -> StorePage:
+    return StorePage(get_store_response(app_id))
 
 # Fetches a response by adding appropriate headers and cookies
 def get_store_response(app_id: int) -> requests.Response:
-    url = f"https://store.steampowered.com/app/{app_id}/"
-    headers = {
-        "User-Agent": "Mozilla/5.0"
-    }
-    
+    url = f"{STORE_URL}/app/{app_id}/"
+
     # Simulate having passed the age check with a cookie
     cookies = {
         'birthtime': '568022401',   # Arbitrary date: Jan 1, 1988
@@ -122,194 +173,208 @@ def get_store_response(app_id: int) -> requests.Response:
         'wants_mature_content': '1'
     }
 
-    response = requests.get(url, headers=headers, cookies=cookies, timeout=10)
+    response = fetcher.get(url, ttl=STORE_PAGE_TTL, cookies=cookies)
     return response
 
+# Returns the appdetails API entry for an app, shared by is_valid_app_id and is_game
+@lru_cache(maxsize=APP_MEMO_SIZE)
+def get_app_details(app_id: int) -> dict:
+    url = f'{STORE_URL}/api/appdetails?appids={app_id}'
+    response = fetcher.get(url, ttl=APP_DETAILS_TTL).json()
+    return response[f'{app_id}']
+
 # >>> Getters
 
 # <<< Validity Checks
 
 def has_tag(tag: str, app_id: int) -> bool:
-    response = get_store_response(app_id)
+    page = get_store_page(app_id)
 
-    if response.status_code != 200:
-        raise Exception(f"Failed to fetch the page, status code: {response.status_code}")
+    if page.status_code != 200:
+        raise Exception(f"Failed to fetch the page, status code: {page.status_code}")
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+    if page.tags is None:
+        raise Exception("No tags found on the store page.")
 
-    genres_container = soup.find("div", {"id": "genresAndManufacturer", "class": "details_block"})
-    genres_data_panel = genres_container.find('span')
-    all_tags_links = genres_data_panel.find_all('a')
-    all_tags = [link.text.lower() for link in all_tags_links]
-    return tag.lower() in all_tags
+    return tag.lower() in page.tags
 
 def has_ss(app_id: int) -> bool:
-    response = get_store_response(app_id)
-    if response.status_code != 200:
+    page = get_store_page(app_id)
+    if page.status_code != 200:
         return False
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    # Find all screenshot thumbnails
-    screenshots = soup.find_all("a", {"class": "highlight_screenshot_link"})
-    if len(screenshots) == 0:
-        print(f"No screenshots found on the store page for AppId: {appid}")
+    if len(page.screenshot_urls) == 0:
+        print(f"No screenshots found on the store page for AppId: {app_id}")
         return False
 
     return True
 
 def has_store_page(app_id: int) -> bool:
-    response = get_store_response(app_id)
+    page = get_store_page(app_id)
 
-    if response.status_code != 200:
+    if page.status_code != 200:
         return False
 
     # Check if redirected to an invalid page (like the homepage or error page)
-    final_url = response.url.lower()
+    final_url = page.url.lower()
     if "app" not in final_url or "agecheck" in final_url:
         return False
 
     # Some nonexistent apps still return 200 with a "not found" message
-    if "app doesn't exist" in response.text.lower() or "application not found" in response.text.lower():
+    if page.not_found:
         return False
 
     return True
 
 def is_valid_app_id(app_id: int) -> bool:
-    url = f'https://store.steampowered.com/api/appdetails?appids={app_id}'
-    response = requests.get(url, timeout=10).json()
-    return response[f'{app_id}']['success']
+    return get_app_details(app_id)['success']
 
 def is_game(app_id: int) -> bool:
-    url = f'https://store.steampowered.com/api/appdetails?appids={app_id}'
-    response = requests.get(url, timeout=10).json()
-    return response[f'{app_id}']['data']['type'] == 'game'
+    return get_app_details(app_id)['data']['type'] == 'game'
 
 # >>> Validity Checks
 
-def download_ss(url: str, path: str):
-    response = requests.get(url, timeout=10)
-    if response.status_code == 200:
-        with open(path, 'wb') as f:
-            for chunk in response.iter_content(1024):
-                f.write(chunk)
+# Fully decodes the image so truncated downloads are caught here rather
+#   than mid-epoch. JPEG draft mode keeps this cheap
+def verify_image(path: Path) -> None:
+    with Image.open(path) as img:
+        img.draft('RGB', (max(1, img.width // 8), max(1, img.height // 8)))
+        img.load()
+
+def resize_image(path: Path, size: int) -> None:
+    with Image.open(path) as img:
+        resized = img.convert('RGB').resize((size, size))
+    resized.save(path, format='JPEG', quality=95)
+
+def hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Moves 'tmp_path' into the blob store unless identical bytes are already
+#   there, then atomically points 'path' at the blob with a hard link
+def store_deduplicated(tmp_path: Path, digest: str, path: Path) -> None:
+    blob_path = path.parent/BLOB_DIR/digest[:2]/f'{digest}.jpeg'
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if blob_path.exists():
+        tmp_path.unlink()
+    else:
+        os.replace(tmp_path, blob_path)
+
+    link_path = path.with_name(f'.{path.name}.{threading.get_ident()}.link')
+    try:
+        os.link(blob_path, link_path)
+    except OSError:
+        shutil.copyfile(blob_path, link_path) # Filesystems without hard links
 
-def download_ss_for_tag(tag: str, download_dir: Path = Path('./data'), count: int = 100):
-    print(f'Downloading {tag} game screenshots...')
-    games = get_games_by_tag(tag, count)
-    for i, game in enumerate(games, start=1):
-        app_id = game['app_id']
-        if app_id is None:
-            print(f'AppId returned None for game {game["name"]}. Skipping...')
-            continue
+    os.replace(link_path, path)
 
-        if app_exists_in_db(app_id):
-            print(f'AppId {app_id} already exists in DB. Only modifying db entry')
-            update_tag_info(game)
-        else:
-            try:
-                ss_url = get_ss_url(app_id)
-            except:
-                print(f'Could not find ss url for {game["name"]} | app_id: {app_id}')
-                continue
+# Streams the screenshot to a temporary file and only moves it into place
+#   once it decodes, so a failed request never leaves a truncated image
+def download_ss(url: str, path: str):
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{threading.get_ident()}.part')
 
-            download_ss(ss_url, f'{download_dir}/{app_id}.jpeg')
-            write_tag_info_to_db(game)
+    response = fetcher.get(url, stream=True)
+    try:
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch the screenshot, status code: {response.status_code}")
 
-        print(f'{tag}: {i}/{len(games)}')
+        h = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                h.update(chunk)
 
-    print(f'✅ Download Complete: {tag}\n')
+        verify_image(tmp_path)
 
-def write_tag_info_to_db(game) -> None:
-    connection = sqlite3.connect('data/tag_info.db')
-    cursor = connection.cursor()
+        if SCREENSHOT_SIZE is None:
+            digest = h.hexdigest()
+        else:
+            resize_image(tmp_path, SCREENSHOT_SIZE)
+            digest = hash_file(tmp_path)
 
-    tag_columns_description = ',\n'.join([f'{tag} BOOLEAN' for tag in tag_dict.keys()])
+        store_deduplicated(tmp_path, digest, path)
+    finally:
+        response.close()
+        tmp_path.unlink(missing_ok=True)
 
-    tuple_entry = (game['app_id'], )
+def record_status(game: dict, status: str) -> None:
+    if manifest is not None:
+        manifest.mark([game], status)
 
-    # game['tag_ids'] returns a string in the format:
-    #   [123,456,78]. Hence, we need to remove the brackets
-    #   before calling .split
-    tag_list = game['tag_ids'][1:-1].split(',')
+def record_failure(game: dict, error: str) -> None:
+    print(f'❌ {error} | app_id: {game["app_id"]}')
+    if manifest is not None:
+        manifest.mark_failed(game, error)
 
-    for tag in tag_dict.keys():
-        game_has_tag = str(tag_dict[tag]) in tag_list
-        tuple_entry += (int(game_has_tag), )
+def download_game(game: dict, download_dir: Path) -> None:
+    app_id = game['app_id']
 
-    cursor.execute(
-        f'''
-        CREATE TABLE IF NOT EXISTS games (
-            app_id INTEGER,
-            {tag_columns_description}
-        )
-        '''
-    )
+    if writer.app_exists(app_id):
+        print(f'AppId {app_id} already exists in DB. Only modifying db entry')
+        writer.put(game)
+        return
 
-    placeholders = ','.join(['?'] * len(tuple_entry))
+    ss_path = Path(f'{download_dir}/{app_id}.jpeg')
 
-    cursor.execute(
-        f'''
-        INSERT INTO games VALUES({placeholders})
-        ''', 
-        tuple_entry
-    )
+    # A resumed game whose screenshot already landed only needs its DB row
+    if game.get('status') != SCREENSHOT_DOWNLOADED or not ss_path.exists():
+        try:
+            ss_url = get_ss_url(app_id)
+        except Exception as e:
+            record_failure(game, f'Could not find ss url for {game["name"]}: {e}')
+            return
 
-    connection.commit()
-    connection.close()
+        record_status(game, PAGE_FETCHED)
 
-def update_tag_info(game) -> None:
-    connection = sqlite3.connect('data/tag_info.db')
-    cursor = connection.cursor()
+        try:
+            download_ss(ss_url, ss_path)
+        except Exception as e:
+            record_failure(game, f'Could not download screenshot for {game["name"]}: {e}')
+            return
 
-    # game['tag_ids'] returns a string in the format:
-    #   [123,456,78]. Hence, we need to remove the brackets
-    #   before calling .split
-    tag_list = game['tag_ids'][1:-1].split(',')
-    tag_names = []
+        record_status(game, SCREENSHOT_DOWNLOADED)
 
-    for tag in tag_dict.keys():
-        game_has_tag = str(tag_dict[tag]) in tag_list
-        if game_has_tag:
-            tag_names.append(tag)
+    writer.put(game) # Marked db_written by the writer once committed
 
-    set_str = '= 1, '.join(tag_names) + '= 1'
+# Lists the games for 'tag' and hands each one to 'executor', which is shared
+#   across tags so the total number of in-flight games stays bounded. With a
+#   manifest, only games not yet written are scraped, at most 'chunk' of them
+def download_ss_for_tag(tag: str, download_dir: Path = Path('./data'), count: int = 100, executor: ThreadPoolExecutor | None = None, chunk: int | None = None):
+    print(f'Downloading {tag} game screenshots...')
+    games = []
+    for game in get_games_by_tag(tag, count):
+        if game['app_id'] is None:
+            print(f'AppId returned None for game {game["name"]}. Skipping...')
+            continue
 
-    try:
-        cursor.execute(
-            f'''
-            UPDATE games SET {set_str} WHERE app_id = {game["app_id"]};
-            '''
-        )
-    except sqlite3.OperationalError as e:
-        print(f'❌ Could not update database for game: {game}. Skipping...')
-        return
+        games.append({**game, 'tag': tag})
 
-    connection.commit()
-    connection.close()
+    if manifest is not None:
+        manifest.add_listed(tag, games)
+        games = manifest.get_pending(tag, chunk)
+    elif chunk is not None:
+        games = games[:chunk]
 
-def app_exists_in_db(app_id: int) -> bool:
-    connection = sqlite3.connect('data/tag_info.db')
-    cursor = connection.cursor()
-    
-    table_exists = cursor.execute(
-        '''
-        SELECT EXISTS (
-            SELECT 1 FROM sqlite_master WHERE type='table' AND name='games'
-        );
-        '''
-    )
-    
-    if table_exists.fetchone()[0] == 0:
-        return False
+    futures = []
+    for game in games:
+        if executor is None:
+            download_game(game, download_dir)
+        else:
+            futures.append(executor.submit(download_game, game, download_dir))
 
-    result = cursor.execute(
-            '''
-            SELECT count(*) FROM games WHERE app_id= ?;
-            ''', (app_id,)
-    )
+    for i, future in enumerate(as_completed(futures), start=1):
+        try:
+            future.result()
+        except Exception as e:
+            print(f'❌ {tag}: failed to scrape a game: {e}')
+        print(f'{tag}: {i}/{len(futures)}')
 
-    return result.fetchone()[0] > 0
+    print(f'✅ Download Complete: {tag}\n')
 
 # <<< Entry
 
@@ -317,6 +382,15 @@ def app_exists_in_db(app_id: int) -> bool:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Script for scraping in-game screenshots from Steam')
     parser.add_argument('-c', '--count', type=int, help='Number of games to scrape per tag', default=100)
+    parser.add_argument('-j', '--concurrency', type=int, help='Maximum number of requests in flight', default=16)
+    parser.add_argument('-r', '--rate', type=float, help='Maximum requests per second to each host', default=5.0)
+    parser.add_argument('--store-url', help='Base URL of the Steam store', default=STORE_URL)
+    parser.add_argument('--api-url', help='Base URL of the Steam web API', default=API_URL)
+    parser.add_argument('--no-cache', action='store_true', help='Always fetch from the network instead of reusing cached pages')
+    parser.add_argument('--cache-size', type=int, help='Maximum size of the response cache in MB', default=512)
+    parser.add_argument('--chunk', type=int, help='Scrape at most this many pending games per tag in this run', default=None)
+    parser.add_argument('--fresh', action='store_true', help='Ignore progress recorded by earlier runs')
+    parser.add_argument('--resize', type=int, help='Re-encode screenshots at this square size while downloading (e.g. 256)', default=None)
     args = parser.parse_args()
 
     data_dir = Path('./data')
@@ -324,9 +398,36 @@ if __name__ == "__main__":
     if not data_dir.exists():
         os.mkdir(data_dir)
 
+    STORE_URL = args.store_url
+    API_URL = args.api_url
+    SCREENSHOT_SIZE = args.resize
+    cache = None if args.no_cache else ResponseCache(data_dir/'http_cache.db', max_bytes=args.cache_size * 1024 * 1024)
+    fetcher = Fetcher(max_concurrency=args.concurrency, rate_per_host=args.rate, cache=cache)
+
+    manifest_path = data_dir/'scrape_manifest.db'
+    if args.fresh:
+        for suffix in ['', '-wal', '-shm']:
+            Path(f'{manifest_path}{suffix}').unlink(missing_ok=True)
+    manifest = ScrapeManifest(manifest_path)
+
+    writer = TagWriter(tag_dict, data_dir/'tag_info.db',
+                       on_written=lambda games: manifest.mark(games, DB_WRITTEN))
+    writer.start()
+
     tags = list(tag_dict.keys())
-    with Pool(len(tags)) as p:
-        download_w_tag_count = partial(download_ss_for_tag, count=args.count)
-        p.map(download_w_tag_count, tags)
+    with ThreadPoolExecutor(args.concurrency) as game_executor, ThreadPoolExecutor(len(tags)) as tag_executor:
+        tag_futures = [tag_executor.submit(download_ss_for_tag, tag, data_dir, args.count, game_executor, args.chunk) for tag in tags]
+        for future in tag_futures:
+            future.result()
+
+    writer.close()
+    print(f'Wrote {writer.rows_written} rows to {data_dir/"tag_info.db"}')
+    if writer.rows_failed > 0:
+        print(f'❌ {writer.rows_failed} rows could not be written')
+
+    if cache is not None:
+        print(f'Response cache: {cache.hits} hits, {cache.misses} misses')
+
+    print(f'Manifest: {manifest.get_summary()}')
 
 # >>> Entry
@@ -0,0 +1,119 @@
+import os
+import time
+import torch
+import signal
+import socket
+import uvicorn
+import argparse
+from pathlib import Path
+
+# Serves model_server with several worker processes that share one copy of
+#   the model. The parent loads it before forking, so every worker sees the
+#   same pages: state dicts are memory-mapped from the read-only file and
+#   anything else (TorchScript artifacts) is moved into shared memory. The
+#   machine's cores are split between the workers so their intra-op thread
+#   pools don't oversubscribe it
+
+RESTART_DELAY = 1 # Seconds before replacing a worker that exited
+
+# Memory-mapped state dicts are already backed by the page cache. Parameters
+#   of a TorchScript module are copied into shared memory; the packed weights
+#   of quantized modules aren't parameters and are shared copy-on-write by
+#   the fork, which never writes to them
+def share_weights(model: torch.nn.Module, model_save_path: Path) -> None:
+    if Path(model_save_path).suffix == '.ts':
+        model.share_memory()
+
+def get_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+# The child never returns: it serves until uvicorn shuts down and exits
+def start_worker(config: uvicorn.Config, sock: socket.socket, threads: int) -> int:
+    pid = os.fork()
+    if pid > 0:
+        return pid
+
+    exit_code = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        torch.set_num_threads(threads)
+
+        uvicorn.Server(config).run(sockets=[sock])
+        exit_code = 0
+    finally:
+        os._exit(exit_code)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves the model with worker processes sharing one preloaded copy of it')
+    parser.add_argument('-m', '--model', type=Path, help='Path to the model state dict or .ts artifact (default: GT_MODEL or models/d5000e30.pt)')
+    parser.add_argument('-w', '--workers', type=int, help='Worker processes', default=2)
+    parser.add_argument('-t', '--threads', type=int, help='Intra-op threads per worker (default: cores / workers, or GT_TORCH_THREADS)')
+    parser.add_argument('--host', type=str, help='Address to bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='Port to bind', default=8000)
+    parser.add_argument('--log-level', type=str, help='uvicorn log level', default='info')
+    args = parser.parse_args()
+
+    cores_per_worker = max(1, os.cpu_count() // args.workers)
+    threads = args.threads or int(os.environ.get('GT_TORCH_THREADS', 0)) or cores_per_worker
+
+    # model_server reads its configuration when it's imported
+    if args.model is not None:
+        os.environ['GT_MODEL'] = str(args.model)
+    os.environ['GT_TORCH_THREADS'] = str(threads)
+    os.environ.setdefault('GT_PREPROCESS_WORKERS', str(cores_per_worker))
+
+    import model_server
+
+    # A single thread while loading keeps the parent from starting an OpenMP
+    #   pool, which the forked workers couldn't use
+    torch.set_num_threads(1)
+    started_at = time.perf_counter()
+    model_server.preload()
+    for version in model_server.registry.routes.get_versions():
+        share_weights(version.model, version.path)
+    print(f'✅ Loaded {model_server.registry.routes.live.path} in {time.perf_counter() - started_at:.2f}s, '
+          f'starting {args.workers} workers with {threads} threads each')
+
+    sock = get_socket(args.host, args.port)
+    config = uvicorn.Config(model_server.app, log_level=args.log_level)
+
+    workers = {start_worker(config, sock, threads): index for index in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+
+        print(f'❌ Worker {index} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, restarting')
+        time.sleep(RESTART_DELAY)
+        if not stopping:
+            workers[start_worker(config, sock, threads)] = index
+
+    sock.close()
+
+if __name__ == "__main__":
+    main()
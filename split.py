@@ -1,72 +1,239 @@
 import sqlite3
-import random
-import sys
+import hashlib
+import argparse
+import numpy as np
+from tag_db import create_unique_index
+from label_stats import get_labels, compute_label_stats, save_label_stats
 
 # ---- Configuration ----
 DB_PATH = "data/tag_info.db"
 SOURCE_TABLE = "games"
 TRAIN_TABLE = "train"
 TEST_TABLE = "test"
-SPLIT_RATIO = 0.8  # 80% train, 20% test
+VALIDATION_TABLE = "validation"
+ASSIGNMENT_TABLE = "split_assignment"
+SPLIT_RATIO = 0.8  # 80% train and validation, 20% test
+VALIDATION_RATIO = 0.1  # Share of the train games held out for tuning thresholds
+SEED = 0
 
 # ------------------------
-def main():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
 
-    # Delete duplicates
-    cursor.execute(
-        f'''DELETE FROM {SOURCE_TABLE}
-            WHERE rowid NOT IN (
-                SELECT MIN(rowid)
-                FROM {SOURCE_TABLE}
-                GROUP BY app_id
-            );
+# Deterministic position of an app in [0, 1), so an app lands in the same
+#   split on every run and on every machine
+def get_split_hash(app_id: int, seed: int | str) -> float:
+    digest = hashlib.blake2b(f'{seed}:{app_id}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2**64
+
+def table_exists(cursor: sqlite3.Cursor, table: str) -> bool:
+    return cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name=?)", (table,)
+    ).fetchone()[0] == 1
+
+# Splits made before assignments were recorded keep their rows: the app ids
+#   already in the train and test tables become their assignments
+def create_assignment_table(cursor: sqlite3.Cursor) -> None:
+    if table_exists(cursor, ASSIGNMENT_TABLE):
+        return
+
+    cursor.execute(f"CREATE TABLE {ASSIGNMENT_TABLE} (app_id INTEGER PRIMARY KEY, split TEXT)")
+
+    for table in [TRAIN_TABLE, TEST_TABLE]:
+        if table_exists(cursor, table):
+            cursor.execute(f"INSERT OR IGNORE INTO {ASSIGNMENT_TABLE} SELECT app_id, '{table}' FROM {table}")
+
+# Moves a fixed VALIDATION_RATIO of the train games to the validation split,
+#   by a hash of their own. Games moved by earlier runs stay, and a train
+#   game that isn't moved when it is first assigned never will be, so the
+#   slice doesn't change afterwards. Databases split before there was a
+#   validation split get theirs carved out of the train games once
+def carve_validation(conn: sqlite3.Connection, seed: int) -> None:
+    conn.create_function('validation_hash', 1, lambda app_id: get_split_hash(app_id, f'{seed}:{VALIDATION_TABLE}'), deterministic=True)
+    conn.execute(
+        f'''UPDATE {ASSIGNMENT_TABLE} SET split = '{VALIDATION_TABLE}'
+            WHERE split = '{TRAIN_TABLE}' AND validation_hash(app_id) < {VALIDATION_RATIO};
+        '''
+    )
+
+# Assigns every new game by hash, entirely inside SQLite
+def assign_by_hash(conn: sqlite3.Connection, seed: int) -> None:
+    conn.create_function('split_hash', 1, lambda app_id: get_split_hash(app_id, seed), deterministic=True)
+    conn.execute(
+        f'''INSERT INTO {ASSIGNMENT_TABLE}
+            SELECT app_id, CASE WHEN split_hash(app_id) < {SPLIT_RATIO} THEN '{TRAIN_TABLE}' ELSE '{TEST_TABLE}' END
+            FROM {SOURCE_TABLE}
+            WHERE app_id NOT IN (SELECT app_id FROM {ASSIGNMENT_TABLE});
+        '''
+    )
+
+# Iterative stratification (Sechidis et al., 2011) of 'labels' into splits
+#   with the given ratios, on top of 'existing_labels'/'existing_rows'
+#   already assigned to each split. Rarest labels are placed first, each row
+#   going to the split that most lacks that label. Returns a split index per row
+def stratify(labels: np.ndarray, ratios: np.ndarray, existing_labels: np.ndarray, existing_rows: np.ndarray, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+
+    desired_rows = ratios * (len(labels) + existing_rows.sum()) - existing_rows
+    desired_labels = ratios[:, None] * (labels.sum(axis=0) + existing_labels.sum(axis=0)) - existing_labels
+
+    assignment = np.full(len(labels), -1)
+
+    def assign(row: int, candidates: np.ndarray) -> None:
+        # Ties are broken by the split that most lacks rows, then randomly
+        best = candidates[desired_rows[candidates] == desired_rows[candidates].max()]
+        split = rng.choice(best)
+        assignment[row] = split
+        desired_labels[split] -= labels[row]
+        desired_rows[split] -= 1
+
+    while True:
+        remaining = labels[assignment == -1].sum(axis=0)
+        if remaining.sum() == 0:
+            break
+
+        label = np.argmin(np.where(remaining > 0, remaining, np.iinfo(np.int64).max))
+        rows = np.flatnonzero((labels[:, label] == 1) & (assignment == -1))
+
+        for row in rng.permutation(rows):
+            wanted = desired_labels[:, label]
+            assign(row, np.flatnonzero(wanted == wanted.max()))
+
+    all_splits = np.arange(len(ratios))
+    for row in rng.permutation(np.flatnonzero(assignment == -1)):
+        assign(row, all_splits)
+
+    return assignment
+
+# Assigns every new game so that each label's positives end up in both
+#   splits in SPLIT_RATIO, counting the games assigned by earlier runs.
+#   Validation games count as train, which they are carved out of. Only the
+#   new games' labels are loaded, as a compact uint8 matrix
+def assign_stratified(conn: sqlite3.Connection, labels: list[str], seed: int) -> None:
+    splits = [TRAIN_TABLE, TEST_TABLE]
+    label_sums = ', '.join(f'coalesce(sum(g.{label}), 0)' for label in labels)
+
+    existing_labels = np.zeros((len(splits), len(labels)), dtype=np.int64)
+    existing_rows = np.zeros(len(splits), dtype=np.int64)
+    result = conn.execute(
+        f'''SELECT a.split, count(*), {label_sums}
+            FROM {SOURCE_TABLE} g JOIN {ASSIGNMENT_TABLE} a ON a.app_id = g.app_id
+            GROUP BY a.split;
+        '''
+    )
+    for split, count, *sums in result.fetchall():
+        index = splits.index(TRAIN_TABLE if split == VALIDATION_TABLE else split)
+        existing_rows[index] += count
+        existing_labels[index] += sums
+
+    rows = conn.execute(
+        f'''SELECT app_id, {', '.join(labels)} FROM {SOURCE_TABLE}
+            WHERE app_id NOT IN (SELECT app_id FROM {ASSIGNMENT_TABLE})
+            ORDER BY app_id;
         '''
-    );
+    ).fetchall()
+
+    if len(rows) == 0:
+        return
+
+    matrix = np.array(rows, dtype=np.int64)
+    assignment = stratify(matrix[:, 1:].astype(np.uint8), np.array([SPLIT_RATIO, 1 - SPLIT_RATIO]),
+                          existing_labels, existing_rows, seed)
+
+    conn.executemany(f"INSERT INTO {ASSIGNMENT_TABLE} VALUES (?, ?)",
+                     [(int(app_id), splits[split]) for app_id, split in zip(matrix[:, 0], assignment)])
+
+# Brings a split table up to date with its assigned games inside SQLite.
+#   New games are inserted, changed tags updated and games that were removed
+#   or moved to another split deleted, so unchanged rows are never rewritten
+def materialize(cursor: sqlite3.Cursor, table: str, labels: list[str]) -> None:
+    # Recreated if the tag vocabulary changed or the table predates app_id
+    #   being its primary key
+    if table_exists(cursor, table):
+        app_id_is_key = ('app_id', 1) in [(item[1], item[5]) for item in cursor.execute(f"PRAGMA table_info({table})")]
+        if get_labels(cursor.connection, table) != labels or not app_id_is_key:
+            cursor.execute(f"DROP TABLE {table}")
+
+    columns_def = "app_id INTEGER PRIMARY KEY, " + ", ".join(f"{label} BOOLEAN" for label in labels)
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns_def})")
+
+    columns = ', '.join(['app_id'] + labels)
+    source_columns = ', '.join(['g.app_id'] + [f'g.{label}' for label in labels])
+    updates = ', '.join(f'{label} = excluded.{label}' for label in labels)
+    changed = ' OR '.join(f'{label} IS NOT excluded.{label}' for label in labels)
 
-    # Delete pre-existing train and test tables
     cursor.execute(
-        f'''DROP TABLE IF EXISTS {TRAIN_TABLE};
+        f'''INSERT INTO {table} ({columns})
+            SELECT {source_columns}
+            FROM {SOURCE_TABLE} g JOIN {ASSIGNMENT_TABLE} a ON a.app_id = g.app_id
+            WHERE a.split = '{table}'
+            ON CONFLICT(app_id) DO UPDATE SET {updates} WHERE {changed};
         '''
-    );
+    )
 
+    # Games that were removed, or moved to another split (as carve_validation
+    #   does with train games)
     cursor.execute(
-        f'''DROP TABLE IF EXISTS {TEST_TABLE};
+        f'''DELETE FROM {table} WHERE app_id NOT IN (
+               SELECT a.app_id FROM {ASSIGNMENT_TABLE} a JOIN {SOURCE_TABLE} g ON g.app_id = a.app_id
+               WHERE a.split = '{table}'
+           );
         '''
-    );
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Splits the scraped games into train, validation and test tables')
+    parser.add_argument('-s', '--stratify', action='store_true', help='Balance every tag across the splits instead of assigning by hash')
+    parser.add_argument('--seed', type=int, help='Seed for the hash or the stratification', default=SEED)
+    parser.add_argument('--rebuild', action='store_true', help='Forget earlier assignments and split every game again')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    # No-op for databases written by the scraper's upserts, which can't hold
+    #   duplicates. Older databases are deduplicated once and indexed
+    create_unique_index(conn)
+
+    if args.rebuild:
+        cursor.execute(f"DROP TABLE IF EXISTS {ASSIGNMENT_TABLE}")
+        cursor.execute(f"DROP TABLE IF EXISTS {TRAIN_TABLE}")
+        cursor.execute(f"DROP TABLE IF EXISTS {TEST_TABLE}")
+        cursor.execute(f"DROP TABLE IF EXISTS {VALIDATION_TABLE}")
 
-    # Fetch all data from the source table
-    cursor.execute(f"SELECT * FROM {SOURCE_TABLE}")
-    rows = cursor.fetchall()
+    create_assignment_table(cursor)
+    assigned_before = cursor.execute(f"SELECT count(*) FROM {ASSIGNMENT_TABLE}").fetchone()[0]
 
-    # Get column names to recreate the schema
-    col_names = [description[0] for description in cursor.description]
-    columns_def = (f"{col_names[0]} INTEGER, " + ", ".join(f"{col} BOOLEAN" for col in col_names[1:]))
+    labels = get_labels(conn, SOURCE_TABLE)
 
-    # Shuffle and split
-    random.shuffle(rows)
-    split_point = int(len(rows) * SPLIT_RATIO)
-    train_rows = rows[:split_point]
-    test_rows = rows[split_point:]
+    # Only games without an assignment are placed; existing ones never move
+    if args.stratify:
+        assign_stratified(conn, labels, args.seed)
+    else:
+        assign_by_hash(conn, args.seed)
+    carve_validation(conn, args.seed)
 
-    # Drop old train/test tables if they exist
-    cursor.execute(f"DROP TABLE IF EXISTS {TRAIN_TABLE}")
-    cursor.execute(f"DROP TABLE IF EXISTS {TEST_TABLE}")
+    assigned_after = cursor.execute(f"SELECT count(*) FROM {ASSIGNMENT_TABLE}").fetchone()[0]
 
-    # Create train and test tables
-    cursor.execute(f"CREATE TABLE {TRAIN_TABLE} ({columns_def})")
-    cursor.execute(f"CREATE TABLE {TEST_TABLE} ({columns_def})")
+    materialize(cursor, TRAIN_TABLE, labels)
+    materialize(cursor, VALIDATION_TABLE, labels)
+    materialize(cursor, TEST_TABLE, labels)
 
-    # Insert data into train and test tables
-    placeholders = ", ".join(["?"] * len(col_names))
-    cursor.executemany(f"INSERT INTO {TRAIN_TABLE} VALUES ({placeholders})", train_rows)
-    cursor.executemany(f"INSERT INTO {TEST_TABLE} VALUES ({placeholders})", test_rows)
+    # Label statistics are committed together with the split they describe
+    train_stats = compute_label_stats(conn, TRAIN_TABLE)
+    validation_stats = compute_label_stats(conn, VALIDATION_TABLE)
+    test_stats = compute_label_stats(conn, TEST_TABLE)
+    save_label_stats(conn, TRAIN_TABLE, train_stats)
+    save_label_stats(conn, VALIDATION_TABLE, validation_stats)
+    save_label_stats(conn, TEST_TABLE, test_stats)
 
     conn.commit()
     conn.close()
-    print(f"Split complete. {len(train_rows)} train rows, {len(test_rows)} test rows.")
+    print(f"Split complete. {train_stats.count} train rows, {validation_stats.count} validation rows, "
+          f"{test_stats.count} test rows ({assigned_after - assigned_before} newly assigned).")
+
+    print("Label prevalence (train / validation / test):")
+    for label, train_prevalence, validation_prevalence, test_prevalence in zip(
+            train_stats.labels, train_stats.prevalence, validation_stats.prevalence, test_stats.prevalence):
+        print(f"\t{label}: {train_prevalence:.3f} / {validation_prevalence:.3f} / {test_prevalence:.3f}")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,128 @@
+import json
+import time
+import random
+import argparse
+import threading
+from io import BytesIO
+from PIL import Image
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tags import tag_dict
+
+# Local stand-in for the parts of the Steam store and web API the scraper
+#   uses. Every tag has 'games_per_tag' games whose app ids and tag lists
+#   are derived from the tag id, so results are deterministic. Point the
+#   scraper at it with --store-url/--api-url (or GT_STORE_URL/GT_API_URL)
+
+GAMES_PER_TAG = 1000
+
+def get_app_id(tag_id: int, index: int) -> int:
+    return tag_id * 100000 + index
+
+def get_tag_ids(app_id: int) -> list[int]:
+    rng = random.Random(app_id)
+    tag_ids = list(tag_dict.values())
+    return sorted(rng.sample(tag_ids, rng.randint(1, 4)))
+
+def make_jpeg(app_id: int, size: tuple[int, int] = (640, 360)) -> bytes:
+    rng = random.Random(app_id)
+    img = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    games_per_tag = GAMES_PER_TAG
+    latency = 0.0
+    fail_rate = 0.0
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send(self, status: int, body: bytes, content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data) -> None:
+        self.send(200, json.dumps(data).encode())
+
+    def do_GET(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if self.fail_rate > 0 and random.random() < self.fail_rate:
+            self.send(random.choice([429, 503]), b'{}')
+            return
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+
+        if url.path.startswith('/ISteamApps/GetAppList'):
+            apps = [{'appid': get_app_id(tag_id, i), 'name': f'Game {get_app_id(tag_id, i)}'}
+                    for tag_id in tag_dict.values() for i in range(self.games_per_tag)]
+            self.send_json({'applist': {'apps': apps}})
+        elif url.path.startswith('/search/results'):
+            self.send_json({'results_html': self.get_search_html(query)})
+        elif url.path.startswith('/api/appdetails'):
+            app_id = query['appids'][0]
+            self.send_json({app_id: {'success': True, 'data': {'type': 'game'}}})
+        elif len(parts) == 2 and parts[0] == 'app':
+            self.send(200, self.get_store_html(int(parts[1])).encode(), 'text/html')
+        elif len(parts) == 2 and parts[0] == 'ss':
+            self.send(200, make_jpeg(int(parts[1].split('.')[0])), 'image/jpeg')
+        else:
+            self.send(404, b'{}')
+
+    def get_search_html(self, query: dict) -> str:
+        tag_id = int(query['tags'][0])
+        start = int(query.get('start', ['1'])[0]) - 1
+        count = min(int(query.get('count', ['100'])[0]), 100)
+
+        rows = []
+        for i in range(start, min(start + count, self.games_per_tag)):
+            app_id = get_app_id(tag_id, i)
+            tag_ids = ','.join(str(t) for t in get_tag_ids(app_id))
+            rows.append(f'<a class="search_result_row ds_collapse_flag" data-ds-appid="{app_id}" data-ds-tagids="[{tag_ids}]">'
+                        f'<span class="title">Game {app_id}</span></a>')
+
+        return '\n'.join(rows)
+
+    def get_store_html(self, app_id: int) -> str:
+        host = self.headers.get('Host')
+        names = {tag_id: name for name, tag_id in tag_dict.items()}
+        tag_links = ''.join(f'<a href="#">{names[t]}</a>' for t in get_tag_ids(app_id))
+        return (f'<html><body><div id="genresAndManufacturer" class="details_block"><span>{tag_links}</span></div>'
+                f'<a class="highlight_screenshot_link" href="http://{host}/ss/{app_id}.jpg?t=1">ss</a></body></html>')
+
+def make_server(port: int = 0, games_per_tag: int = GAMES_PER_TAG, latency: float = 0.0, fail_rate: float = 0.0) -> ThreadingHTTPServer:
+    handler = type('Handler', (StubHandler,), {
+        'games_per_tag': games_per_tag,
+        'latency': latency,
+        'fail_rate': fail_rate
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+# Starts the server on a background thread and returns it along with its base URL
+def start_server(**kwargs) -> tuple[ThreadingHTTPServer, str]:
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stub of the Steam store for testing the scraper')
+    parser.add_argument('-p', '--port', type=int, help='Port to listen on', default=8089)
+    parser.add_argument('-g', '--games-per-tag', type=int, help='Number of games listed under each tag', default=GAMES_PER_TAG)
+    parser.add_argument('-l', '--latency', type=float, help='Seconds to wait before answering each request', default=0.0)
+    parser.add_argument('-f', '--fail-rate', type=float, help='Fraction of requests answered with 429/503', default=0.0)
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.games_per_tag, args.latency, args.fail_rate)
+    print(f'Serving stub Steam store on http://127.0.0.1:{args.port}')
+    server.serve_forever()
@@ -0,0 +1,171 @@
+import time
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable
+
+DB_PATH = Path('data/tag_info.db')
+TABLE = 'games'
+
+def configure_connection(connection: sqlite3.Connection) -> None:
+    # WAL lets readers (split.py, the trainer) run while the scraper writes
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+
+def create_table(connection: sqlite3.Connection, tags: list[str]) -> None:
+    tag_columns_description = ',\n'.join([f'{tag} BOOLEAN' for tag in tags])
+
+    connection.execute(
+        f'''
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            app_id INTEGER,
+            {tag_columns_description}
+        )
+        '''
+    )
+
+# Databases scraped before app_id was unique may hold duplicate rows. Keeps
+#   the first row of each app, as split.py used to, then adds the index
+#   that lets writes upsert instead
+def create_unique_index(connection: sqlite3.Connection) -> None:
+    index_exists = connection.execute(
+        f'''
+        SELECT EXISTS (
+            SELECT 1 FROM sqlite_master WHERE type='index' AND name='{TABLE}_app_id'
+        );
+        '''
+    ).fetchone()[0]
+
+    if index_exists:
+        return
+
+    with connection:
+        connection.execute(
+            f'''DELETE FROM {TABLE}
+                WHERE rowid NOT IN (
+                    SELECT MIN(rowid)
+                    FROM {TABLE}
+                    GROUP BY app_id
+                );
+            '''
+        )
+        connection.execute(f'CREATE UNIQUE INDEX {TABLE}_app_id ON {TABLE}(app_id)')
+
+# Returns the row for 'game' as (app_id, has_tag_1, has_tag_2, ...)
+def get_row(game: dict, tag_dict: dict) -> tuple:
+    # game['tag_ids'] returns a string in the format:
+    #   [123,456,78]. Hence, we need to remove the brackets
+    #   before calling .split
+    tag_list = game['tag_ids'][1:-1].split(',')
+
+    tuple_entry = (int(game['app_id']), )
+    for tag in tag_dict.keys():
+        game_has_tag = str(tag_dict[tag]) in tag_list
+        tuple_entry += (int(game_has_tag), )
+
+    return tuple_entry
+
+# Owns the only write connection to the database. Scraper threads enqueue
+#   games with put() and this thread writes them in batches, one transaction
+#   per batch. A game seen again under another tag only ever gains tags.
+#   'on_written' is called with the games of each batch once it is committed
+class TagWriter(threading.Thread):
+    def __init__(self, tag_dict: dict, db_path: Path = DB_PATH, batch_size: int = 100, flush_interval: float = 1.0,
+                 on_written: Callable[[list[dict]], None] | None = None) -> None:
+        super().__init__(name='tag-writer', daemon=True)
+        self.tag_dict = tag_dict
+        self.on_written = on_written
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.rows_written = 0
+        self.rows_failed = 0
+
+        connection = sqlite3.connect(db_path)
+        configure_connection(connection)
+        create_table(connection, list(tag_dict.keys()))
+        create_unique_index(connection)
+        self.known_app_ids = {row[0] for row in connection.execute(f'SELECT app_id FROM {TABLE}')}
+        connection.close()
+
+        self._lock = threading.Lock()
+        self._stop_marker = object()
+
+    # True if the app is already stored or waiting to be written
+    def app_exists(self, app_id) -> bool:
+        with self._lock:
+            return int(app_id) in self.known_app_ids
+
+    def put(self, game: dict) -> None:
+        row = get_row(game, self.tag_dict)
+        with self._lock:
+            self.known_app_ids.add(row[0])
+        self.queue.put((row, game))
+
+    def get_upsert_sql(self) -> str:
+        tags = list(self.tag_dict.keys())
+        placeholders = ','.join(['?'] * (len(tags) + 1))
+        updates = ', '.join(f'{tag} = max({tag}, excluded.{tag})' for tag in tags)
+
+        return f'''
+            INSERT INTO {TABLE} VALUES({placeholders})
+            ON CONFLICT(app_id) DO UPDATE SET {updates}
+            '''
+
+    def run(self) -> None:
+        connection = sqlite3.connect(self.db_path)
+        configure_connection(connection)
+        sql = self.get_upsert_sql()
+
+        batch = []
+        batch_started = 0.0
+        stopping = False
+
+        # A batch is written once it is full or has waited 'flush_interval'
+        while not stopping:
+            timeout = self.flush_interval
+            if len(batch) > 0:
+                timeout = max(0.0, batch_started + self.flush_interval - time.monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is self._stop_marker:
+                    stopping = True
+                else:
+                    if len(batch) == 0:
+                        batch_started = time.monotonic()
+                    batch.append(item)
+            except queue.Empty:
+                pass
+
+            if len(batch) > 0 and (stopping or len(batch) >= self.batch_size or time.monotonic() - batch_started >= self.flush_interval):
+                # Any error only loses this batch, the thread keeps writing
+                try:
+                    with connection:
+                        connection.executemany(sql, [row for row, _ in batch])
+                except Exception as e:
+                    self.rows_failed += len(batch)
+                    print(f'❌ Could not write {len(batch)} games to the database: {e}')
+                else:
+                    self.rows_written += len(batch) # Committed
+                    self.notify([game for _, game in batch])
+                batch = []
+
+        connection.close()
+
+    # A failing callback is reported; the games are written regardless
+    def notify(self, games: list[dict]) -> None:
+        if self.on_written is None:
+            return
+
+        try:
+            self.on_written(games)
+        except Exception as e:
+            print(f'❌ Wrote {len(games)} games, but on_written failed: {e}')
+
+    # Flushes everything queued so far and stops the thread
+    def close(self) -> None:
+        self.queue.put(self._stop_marker)
+        self.join()
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import torch
+import sqlite3
+import argparse
+import inference
+from pathlib import Path
+from torch.utils.data import Dataset, DataLoader
+from preprocessing import ImagePreprocessor
+
+IMAGE_SUFFIXES = {'.jpeg', '.jpg', '.png', '.webp', '.bmp'}
+
+# Images decoded and resized the way the model was trained, so
+#   'preprocessor' has to come from the model's manifest:
+#   ImagePreprocessor(meta.image_size)
+class ImagePathDataset(Dataset):
+    def __init__(self, paths: list[str], preprocessor: ImagePreprocessor) -> None:
+        self.paths = paths
+        self.preprocessor = preprocessor
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    # Returns None for the image when it can't be decoded so one bad file
+    #   doesn't stop the run
+    def __getitem__(self, index: int) -> tuple:
+        path = self.paths[index]
+        try:
+            return (self.preprocessor.to_uint8(path), path, None)
+        except Exception as e:
+            return (None, path, str(e))
+
+def collate(items: list[tuple]) -> tuple:
+    decoded = [item for item in items if item[0] is not None]
+    failed = [(path, error) for _, path, error in items if error is not None]
+
+    batch = torch.stack([item[0] for item in decoded]) if decoded else None
+    return (batch, [item[1] for item in decoded], failed)
+
+# Expands directories (recursively) and .txt files listing one path per line
+def get_image_paths(inputs: list[str]) -> list[str]:
+    paths = []
+
+    for item in inputs:
+        item_path = Path(item)
+        if item_path.is_dir():
+            paths.extend(str(p) for p in sorted(item_path.rglob('*')) if p.suffix.lower() in IMAGE_SUFFIXES)
+        elif item_path.suffix.lower() == '.txt':
+            paths.extend(line.strip() for line in item_path.read_text().splitlines() if line.strip())
+        else:
+            paths.append(str(item_path))
+
+    return paths
+
+class JsonlWriter:
+    def __init__(self, output: Path) -> None:
+        self.output = output
+        self.file = None
+
+    # Lines with an error are dropped from the output so those images are
+    #   retried, and their new line is the only one for them
+    def done_paths(self) -> set[str]:
+        if not self.output.exists():
+            return set()
+
+        done = set()
+        kept = []
+        dropped = 0
+        with open(self.output) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    path = result['path']
+                except (json.JSONDecodeError, KeyError):
+                    dropped += 1 # A partially written last line from an interrupted run
+                    continue
+
+                if 'error' in result:
+                    dropped += 1
+                    continue
+
+                done.add(path)
+                kept.append(line if line.endswith('\n') else line + '\n')
+
+        if dropped > 0:
+            tmp_path = self.output.with_name(f'.{self.output.name}.tmp')
+            tmp_path.write_text(''.join(kept))
+            tmp_path.replace(self.output)
+
+        return done
+
+    def write(self, results: list[dict]) -> None:
+        if self.file is None:
+            self.file = open(self.output, 'a')
+
+        for result in results:
+            self.file.write(json.dumps(result) + '\n')
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+class SqliteWriter:
+    def __init__(self, output: Path) -> None:
+        self.connection = sqlite3.connect(output)
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS predictions (
+                path TEXT PRIMARY KEY,
+                tags TEXT,
+                probabilities TEXT,
+                error TEXT
+            )
+            '''
+        )
+
+    # Rows with an error are retried; INSERT OR REPLACE overwrites them
+    def done_paths(self) -> set[str]:
+        result = self.connection.execute('SELECT path FROM predictions WHERE error IS NULL')
+        return {row[0] for row in result.fetchall()}
+
+    def write(self, results: list[dict]) -> None:
+        rows = [(result['path'],
+                 json.dumps(result.get('tags')),
+                 json.dumps(result.get('probabilities')),
+                 result.get('error')) for result in results]
+
+        self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Tags a directory or list of screenshots in batches with a trained model')
+    parser.add_argument('inputs', nargs='+', help='Image files, directories, or .txt files listing image paths')
+    parser.add_argument('-o', '--output', type=Path, help='Results file, .jsonl or .db (SQLite)', default=Path('predictions.jsonl'))
+    parser.add_argument('-m', '--model', type=Path, help='Path to the model state dict', default=Path('models/d5000e30.pt'))
+    parser.add_argument('-b', '--batch-size', type=int, help='Images per forward pass', default=64)
+    parser.add_argument('-w', '--workers', type=int, help='DataLoader workers decoding images', default=os.cpu_count())
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    meta = inference.load_meta(args.model)
+    model = inference.load_model(args.model, device, meta)
+
+    writer = SqliteWriter(args.output) if args.output.suffix == '.db' else JsonlWriter(args.output)
+
+    # Resume by skipping everything already tagged without an error
+    done = writer.done_paths()
+    paths = [path for path in get_image_paths(args.inputs) if path not in done]
+    print(f'Tagging {len(paths)} images ({len(done)} already done)')
+
+    loader = DataLoader(dataset=ImagePathDataset(paths, ImagePreprocessor(meta.image_size)),
+                        batch_size=args.batch_size,
+                        num_workers=args.workers,
+                        collate_fn=collate)
+
+    start = time.perf_counter()
+    tagged = 0
+
+    try:
+        for i, (batch, batch_paths, failed) in enumerate(loader, 1):
+            results = [{'path': path, 'error': error} for path, error in failed]
+
+            if batch is not None:
+                probs = inference.get_probs(model, batch, device)
+                for path, row in zip(batch_paths, probs):
+                    results.append({
+                        'path': path,
+                        'tags': meta.get_labels(row),
+                        'probabilities': meta.get_probabilities(row)
+                    })
+
+            writer.write(results)
+            tagged += len(results)
+
+            if i % 10 == 0:
+                print(f'{tagged}/{len(paths)} images | {tagged / (time.perf_counter() - start):.1f} images/sec')
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f'Tagged {tagged} images in {elapsed:.1f}s ({tagged / max(elapsed, 1e-9):.1f} images/sec)')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+# Steam tag names (also the label and database column names) and their
+#   Steam tag ids. Kept apart from scraper.py so the model side can import
+#   the vocabulary without the scraper's dependencies
+tag_dict = {
+        'Platformer': 1625,
+        'Action': 19,
+        'Casual': 597,
+        'Adventure': 21,
+        'TwoD': 3871,
+        'ThreeD': 4191,
+        'Simulation': 599,
+        'Strategy': 9,
+        'RPG': 122,
+        'Puzzle': 1664,
+        'Horror': 1667,
+        'Sports': 701
+}
@@ -0,0 +1,58 @@
+import sys
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import split
+from benchmarks.synthetic import make_tag_db
+
+def run_split(db_path: Path, *flags: str) -> None:
+    with mock.patch.object(split, 'DB_PATH', str(db_path)), mock.patch.object(sys, 'argv', ['split.py', *flags]), \
+            mock.patch('builtins.print'):
+        split.main()
+
+def get_app_ids(db_path: Path, table: str) -> set[int]:
+    connection = sqlite3.connect(db_path)
+    try:
+        return {row[0] for row in connection.execute(f'SELECT app_id FROM {table}')}
+    finally:
+        connection.close()
+
+# A database split before there was a validation split gets one carved out
+#   of its train games, which have to leave the train table
+class CarveValidationTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.directory.name)/'tag_info.db'
+        make_tag_db(self.db_path, list(range(1000, 2000)))
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def check_resplit(self, *flags: str) -> None:
+        with mock.patch.object(split, 'VALIDATION_RATIO', 0):
+            run_split(self.db_path, *flags)
+        self.assertEqual(get_app_ids(self.db_path, split.VALIDATION_TABLE), set())
+
+        run_split(self.db_path, *flags)
+
+        train = get_app_ids(self.db_path, split.TRAIN_TABLE)
+        validation = get_app_ids(self.db_path, split.VALIDATION_TABLE)
+        test = get_app_ids(self.db_path, split.TEST_TABLE)
+
+        self.assertGreater(len(validation), 0)
+        self.assertEqual(train & validation, set())
+        self.assertEqual(train & test, set())
+        self.assertEqual(validation & test, set())
+        self.assertEqual(train | validation | test, set(range(1000, 2000)))
+
+    def test_hash(self) -> None:
+        self.check_resplit()
+
+    def test_stratified(self) -> None:
+        self.check_resplit('--stratify')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import os
+import time
 import torch
 import random
 import sqlite3
@@ -7,14 +8,36 @@ import matplotlib.pyplot as plt
 import numpy as np
 from pathlib import Path
 from PIL import Image
-from torch.utils.data import DataLoader
+from contextlib import nullcontext
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from torchvision import datasets, transforms
 from model import MultiLabelClassifier
 from dataset import CustomDataset
-from torchmetrics.classification import MultilabelAccuracy, MultilabelPrecision, MultilabelRecall, MultilabelF1Score
+from preprocess import build_shards
+from preprocessing import ImagePreprocessor, to_float
+from label_stats import get_label_stats
+from checkpoint import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state, LATEST, BEST
+from evaluation import EvalAccumulator, get_confusion_counts, compute_metrics, find_thresholds
+from model_meta import ModelMeta, save_meta, replace_file
+from profiling import TraceCapture
 
 parser = argparse.ArgumentParser(description='Trainer script for model defined in model.py')
 parser.add_argument('-e', '--epochs', type=int, help='Maximum number of epochs to train', default=20)
+parser.add_argument('-s', '--shards', action='store_true', help='Train from preprocessed image shards (built on first use) instead of decoding JPEGs every epoch')
+parser.add_argument('-b', '--batch-size', type=int, help='Number of images per batch', default=8)
+parser.add_argument('-w', '--workers', type=int, help='DataLoader worker processes per loader (default: one per core, or a share of this rank\'s cores with -d)', default=None)
+parser.add_argument('-t', '--threads', type=int, help='Intra-op threads per process (default: torch\'s own, or this rank\'s cores not used by workers with -d)', default=None)
+parser.add_argument('-d', '--distributed', action='store_true', help='DistributedDataParallel over gloo; launch with torchrun --nproc-per-node N trainer.py -d')
+parser.add_argument('-f', '--fast', action='store_true', help='Mixed precision (bfloat16 on CPU, float16 on CUDA), channels-last and torch.compile')
+parser.add_argument('--no-compile', action='store_true', help='Leave out torch.compile from --fast, e.g. where no C++ compiler is available')
+parser.add_argument('--checkpoint-dir', type=Path, help='Directory for latest.pt, best.pt and the loss plot', default=Path('checkpoints'))
+parser.add_argument('--checkpoint-every', type=int, help='Write latest.pt every N epochs (best.pt is written whenever test loss improves)', default=1)
+parser.add_argument('--resume', type=Path, nargs='?', const=LATEST, help='Resume from a checkpoint (default: latest.pt in --checkpoint-dir)', default=None)
+parser.add_argument('--profile', type=int, help='Write a torch.profiler trace of N training steps (after the first) to trace.json in --checkpoint-dir', default=0)
+parser.add_argument('-n', '--non-interactive', action='store_true', help='Save the loss plot to a file and skip the save prompts')
+parser.add_argument('-m', '--model-name', help='Save the final model to models/ under this name without prompting', default=None)
 args = parser.parse_args()
 
 def show_image(img_array) -> None:
@@ -23,72 +46,139 @@ def show_image(img_array) -> None:
     plt.imshow(img_array)
     plt.show()
 
-def get_weights(db: Path) -> list[float]:
-    connection = sqlite3.connect(db);
-    cursor = connection.cursor();
-
-    columns = cursor.execute(
-        '''
-        PRAGMA table_info(train);
-        '''
-    )
-
-    labels = [item[1] for item in columns.fetchall()][1:] # First column is app_id
-    
-    result = []
-
-    for label in labels:
-        num_positive = cursor.execute(
-            f'''
-            SELECT count(*) FROM train WHERE {label}=1;
-            '''
-        ).fetchone()[0]
+def prepare_inputs(inputs: torch.Tensor) -> torch.Tensor:
+    # Images arrive as uint8 and are scaled once they are on the device
+    inputs = to_float(inputs.to(device, non_blocking=True))
+    if args.fast:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
 
-        num_negative = cursor.execute(
-            f'''
-            SELECT count(*) FROM train WHERE {label}=0;
-            '''
-        ).fetchone()[0]
+# e.g. 'data wait 12.1s (40%) | compute 18.2s (60%)'
+def format_time_split(data_wait: float, total: float) -> str:
+    compute = max(0.0, total - data_wait)
+    return f'data wait {data_wait:.1f}s ({data_wait / total:.0%}) | compute {compute:.1f}s ({compute / total:.0%})'
 
-        result.append(float(num_negative) / float(num_positive))
+def get_autocast():
+    if not args.fast:
+        return nullcontext()
+    return torch.autocast(device_type=device, dtype=amp_dtype)
 
-    connection.close()
-    return result
+def get_weights(db: Path) -> list[float]:
+    return get_label_stats(db, 'train').get_pos_weights().tolist()
+
+def all_reduce_sum(value: torch.Tensor) -> torch.Tensor:
+    if args.distributed:
+        dist.all_reduce(value, op=dist.ReduceOp.SUM)
+    return value
+
+# torchrun sets RANK/WORLD_SIZE/LOCAL_WORLD_SIZE for each process
+rank = 0
+world_size = 1
+local_world_size = 1
+if args.distributed:
+    dist.init_process_group(backend='gloo')
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+
+is_main_process = rank == 0
+
+# Only rank 0 reports, checkpoints and saves
+def log(*values, **kwargs) -> None:
+    if is_main_process:
+        print(*values, **kwargs)
 
 data_path = Path('data')
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 db_file = 'tag_info.db'
 
-data_transform = transforms.Compose([
-                    transforms.Lambda(lambda img: img.convert("RGB")),
-                    transforms.Resize(size=(256,256)),
-                    transforms.ToTensor()
-                ])
+# Under -d each rank on this machine gets an equal share of the cores, split
+#   between DataLoader workers and intra-op threads so they don't
+#   oversubscribe it. Decoding JPEGs needs more workers than reading shards.
+#   A single process keeps a worker per core and torch's own thread count
+if args.distributed:
+    cores_per_rank = max(1, os.cpu_count() // local_world_size)
+    workers = args.workers if args.workers is not None else cores_per_rank // (4 if args.shards else 2)
+    threads = args.threads if args.threads is not None else max(1, cores_per_rank - workers)
+else:
+    workers = args.workers if args.workers is not None else os.cpu_count()
+    threads = args.threads if args.threads is not None else torch.get_num_threads()
+torch.set_num_threads(threads)
+log(f'{world_size} process(es), {workers} DataLoader workers and {threads} threads each')
+
+# Rank 0 builds missing shards while the other ranks wait for it
+def get_shard_path(table: str) -> Path | None:
+    if not args.shards:
+        return None
+
+    if args.distributed and not is_main_process:
+        dist.barrier()
+    shard_path = build_shards(data_path, db_file, table, image_size)
+    if args.distributed and is_main_process:
+        dist.barrier()
+
+    return shard_path
+
+image_size = 256
+
+# Decoded at reduced scale straight to uint8, the same pixels the shards
+#   and the server get
+data_transform = ImagePreprocessor(size=image_size).to_uint8
 
 train_data = CustomDataset(data_path=data_path,
                            db_file=db_file,
                            table='train',
-                           transform=data_transform)
+                           transform=data_transform,
+                           shard_path=get_shard_path('train'))
+
+# Held out of train to tune the thresholds on, so the test metrics at the
+#   tuned thresholds aren't measured on the data they were fitted to
+validation_data = CustomDataset(data_path=data_path,
+                                db_file=db_file,
+                                table='validation',
+                                transform=data_transform,
+                                shard_path=get_shard_path('validation'))
 
 test_data = CustomDataset(data_path=data_path,
                            db_file=db_file,
                            table='test',
-                           transform=data_transform)
+                           transform=data_transform,
+                           shard_path=get_shard_path('test'))
+
+BATCH_SIZE = args.batch_size
+
+# Keeping workers alive between epochs and letting them run further ahead
+#   only matters with workers; pinned memory only with CUDA
+loader_options = {'num_workers': workers, 'pin_memory': device == 'cuda'}
+if workers > 0:
+    loader_options['persistent_workers'] = True
+    loader_options['prefetch_factor'] = 4 if args.fast else 2
 
-BATCH_SIZE = 8
+# Each rank sees its own 1/world_size of every split
+train_sampler = DistributedSampler(train_data, shuffle=True) if args.distributed else None
+validation_sampler = DistributedSampler(validation_data, shuffle=False) if args.distributed else None
+test_sampler = DistributedSampler(test_data, shuffle=False) if args.distributed else None
 
 train_dataloader = DataLoader(dataset = train_data,
                               batch_size = BATCH_SIZE,
-                              num_workers = os.cpu_count(),
-                              shuffle = True)
+                              shuffle = train_sampler is None,
+                              sampler = train_sampler,
+                              **loader_options)
+
+validation_dataloader = DataLoader(dataset = validation_data,
+                                   batch_size = BATCH_SIZE,
+                                   sampler = validation_sampler,
+                                   **loader_options)
 
 test_dataloader = DataLoader(dataset = test_data,
                              batch_size = BATCH_SIZE,
-                             num_workers = os.cpu_count())
+                             sampler = test_sampler,
+                             **loader_options)
 
 label_count = len(train_data.classes)
 
-model = MultiLabelClassifier(in_count = 3, hidden_count = 128, out_count = label_count)
+hidden_count = 128
+model = MultiLabelClassifier(in_count = 3, hidden_count = hidden_count, out_count = label_count)
 
 loss_fn = torch.nn.BCEWithLogitsLoss(pos_weight=torch.Tensor(get_weights(data_path/db_file)).to(device))
 optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
@@ -97,6 +187,19 @@ epochs = args.epochs
 
 model.to(device)
 
+# bfloat16 needs no loss scaling; float16 on CUDA does
+amp_dtype = torch.float16 if device == 'cuda' else torch.bfloat16
+scaler = torch.amp.GradScaler(device, enabled=args.fast and amp_dtype == torch.float16)
+
+# 'model' keeps the plain module for saving; 'forward_model' is what runs
+forward_model = model
+if args.fast:
+    model.to(memory_format=torch.channels_last)
+if args.distributed:
+    forward_model = DistributedDataParallel(model)
+if args.fast and not args.no_compile:
+    forward_model = torch.compile(forward_model)
+
 train_losses = []
 test_losses = []
 
@@ -104,105 +207,224 @@ stopping_patience = 4
 best_loss = float('inf')
 min_improvement = 1e-3
 epochs_without_improvement = 0
-
-print(f'Started training for {epochs} epochs')
-for epoch in range(1, epochs+1):
-    print(f'Started training in epoch {epoch}')
+start_epoch = 1
+
+threshold = 0.5
+thresholds = torch.full((label_count,), threshold)
+
+if args.resume is not None:
+    resume_path = args.resume if args.resume.exists() else args.checkpoint_dir/args.resume
+    checkpoint = load_checkpoint(resume_path)
+
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    # A run without --fast saves the empty state of a disabled scaler
+    if scaler.is_enabled() and checkpoint['scaler']:
+        scaler.load_state_dict(checkpoint['scaler'])
+    set_rng_state(checkpoint['rng'])
+
+    train_losses = checkpoint['train_losses']
+    test_losses = checkpoint['test_losses']
+    best_loss = checkpoint['best_loss']
+    epochs_without_improvement = checkpoint['epochs_without_improvement']
+    start_epoch = checkpoint['epoch'] + 1
+    thresholds = torch.tensor(checkpoint.get('thresholds', thresholds.tolist()))
+    log(f'Resumed from {resume_path} after epoch {checkpoint["epoch"]}')
+
+# Runs the model over a whole split. Returns the gathered probabilities and
+#   labels, and the mean loss, sample count, time and data wait summed over
+#   ranks
+def evaluate(dataloader: DataLoader, name: str, show_sample: bool = False) -> tuple:
+    loss = torch.zeros((), device=device)
+    samples = 0
+    started_at = time.perf_counter()
+    data_wait = 0.0
+
+    # Sized for this rank's share of the split
+    accumulator = EvalAccumulator(len(dataloader.sampler), label_count, device)
+
+    with torch.inference_mode():
+        waiting_since = time.perf_counter()
+        for i, (inputs, labels_truth) in enumerate(dataloader, 1):
+            data_wait += time.perf_counter() - waiting_since
+            if i % 50 == 0:
+                log(f'{name} batch {i}/{len(dataloader)}')
+            inputs = prepare_inputs(inputs)
+            labels_truth = labels_truth.to(device, non_blocking=True)
+
+            with get_autocast():
+                labels_pred = forward_model(inputs).float()
+            if show_sample and i == 1:
+                log(f'Sample prediction    : {(torch.sigmoid(labels_pred[0]) > threshold).float().cpu().tolist()}')
+                log(f'Corresponding truth : {labels_truth[0].cpu().tolist()}')
+
+            loss += loss_fn(labels_pred, labels_truth)
+            samples += len(inputs)
+
+            accumulator.add(torch.sigmoid(labels_pred), labels_truth)
+            waiting_since = time.perf_counter()
+
+    probs, labels = accumulator.gather(len(dataloader.dataset)) # Without the sampler's padding
+    samples = int(all_reduce_sum(torch.tensor(samples)).item())
+    loss = all_reduce_sum(loss).item() / (max(1, len(dataloader)) * world_size)
+
+    return probs, labels, loss, samples, time.perf_counter() - started_at, data_wait
+
+checkpoint_writer = CheckpointWriter(args.checkpoint_dir) if is_main_process else None
+
+# The first step is left out of the trace, it mostly shows one-off setup
+trace_capture = TraceCapture(args.profile if is_main_process else 0, args.checkpoint_dir/'trace.json', skip=1)
+
+log(f'Started training for {epochs} epochs')
+for epoch in range(start_epoch, epochs+1):
+    log(f'Started training in epoch {epoch}')
     model.train()
 
-    train_loss = 0
+    if train_sampler is not None:
+        train_sampler.set_epoch(epoch) # Reshuffles differently every epoch
+
+    # Accumulated on the device so there's no sync per batch
+    train_loss = torch.zeros((), device=device)
+    train_samples = 0
+    train_start = time.perf_counter()
+
+    # Time spent waiting for the DataLoader to hand over the next batch; the
+    #   rest is compute. On CUDA kernels run asynchronously, so part of the
+    #   compute can show up as waiting instead
+    train_data_wait = 0.0
+    waiting_since = time.perf_counter()
 
     for i, (inputs, labels_truth) in enumerate(train_dataloader, 1):
+        train_data_wait += time.perf_counter() - waiting_since
+
         if i % 100 == 0:
-            print(f'Training batch {i}/{len(train_dataloader)}')
-        inputs = inputs.to(device)
-        labels_truth = labels_truth.to(device)
+            log(f'Training batch {i}/{len(train_dataloader)}')
 
-        labels_pred = model(inputs)
+        with trace_capture.step():
+            inputs = prepare_inputs(inputs)
+            labels_truth = labels_truth.to(device, non_blocking=True)
 
-        loss = loss_fn(labels_pred, labels_truth)
-        train_loss += loss.item()
+            with get_autocast():
+                labels_pred = forward_model(inputs)
+                loss = loss_fn(labels_pred.float(), labels_truth)
 
-        optimizer.zero_grad()
+            train_loss += loss.detach()
+            train_samples += len(inputs)
 
-        loss.backward()
+            optimizer.zero_grad()
 
-        optimizer.step()
-        
-    print('Training complete\n')
+            scaler.scale(loss).backward()
+
+            scaler.step(optimizer)
+            scaler.update()
+
+        waiting_since = time.perf_counter()
+
+    # Losses and sample counts are summed over ranks
+    train_samples = int(all_reduce_sum(torch.tensor(train_samples)).item())
+    train_loss = all_reduce_sum(train_loss).item() / (len(train_dataloader) * world_size)
+    train_time = time.perf_counter() - train_start
+
+    log(f'Training complete ({train_samples / train_time:.1f} samples/sec)')
+    log(f'\t{format_time_split(train_data_wait, train_time)}\n')
 
-    train_loss /= len(train_dataloader)
     train_losses.append(train_loss)
 
-    test_loss = 0
-
-    threshold = 0.5
-    metric_acc = MultilabelAccuracy(num_labels=label_count, threshold=threshold, average=None).to(device)
-    metric_prec = MultilabelPrecision(num_labels=label_count, threshold=threshold, average=None).to(device)
-    metric_rec = MultilabelRecall(num_labels=label_count, threshold=threshold, average=None).to(device)
-    metric_f1 = MultilabelF1Score(num_labels=label_count, threshold=threshold, average=None).to(device)
-
-    for i, (inputs, labels_truth) in enumerate(test_dataloader, 1):
-        if i % 50 == 0:
-            print(f'Testing batch {i}/{len(test_dataloader)}')
-        inputs = inputs.to(device)
-        labels_truth = labels_truth.to(device)
-
-        labels_pred = model(inputs)
-        if i == 1:
-            print(f'Sample prediction    : {(torch.sigmoid(labels_pred[0]) > threshold).float().cpu().tolist()}')
-            print(f'Corresponding truth : {labels_truth[0].cpu().tolist()}')
-
-        loss = loss_fn(labels_pred, labels_truth)
-        test_loss += loss.item()
-        
-        accuracy = metric_acc(labels_pred, labels_truth)
-        precision = metric_prec(labels_pred, labels_truth)
-        recall = metric_rec(labels_pred, labels_truth)
-        f1_score = metric_f1(labels_pred, labels_truth)
-
-    accuracy = metric_acc.compute()
-    precision = metric_prec.compute()
-    recall = metric_rec.compute()
-    f1_score = metric_f1.compute()
-
-    test_loss /= len(test_dataloader)
+    model.eval()
+
+    # Tuned on the validation split, then applied to the test split as is.
+    #   Every rank gets the whole split's outputs, so all of them tune the
+    #   same thresholds
+    if len(validation_data) > 0:
+        probs, labels, _, _, _, _ = evaluate(validation_dataloader, 'Validating')
+        thresholds = find_thresholds(probs, labels, threshold).cpu()
+
+    probs, labels, test_loss, test_samples, test_time, test_data_wait = evaluate(test_dataloader, 'Testing', show_sample=True)
+    metrics = compute_metrics(get_confusion_counts(probs, labels, torch.full((label_count,), threshold)))
+    tuned_metrics = compute_metrics(get_confusion_counts(probs, labels, thresholds))
     test_losses.append(test_loss)
 
-    print(f'Epoch {epoch}: Train Loss: {train_loss} | Test Loss: {test_loss}')
-    print(f'\tAccuracy: {accuracy.cpu().tolist()}')
-    print(f'\tPrecision: {precision.cpu().tolist()}')
-    print(f'\tRecall: {recall.cpu().tolist()}')
-    print(f'\tF1 Score: {f1_score.cpu().tolist()}')
-    print()
+    log(f'Epoch {epoch}: Train Loss: {train_loss} | Test Loss: {test_loss}')
+    log(f'\tThroughput: {train_samples / train_time:.1f} train samples/sec | {test_samples / test_time:.1f} test samples/sec')
+    log(f'\tTest {format_time_split(test_data_wait, test_time)}')
+    log(f'\tAccuracy: {metrics["accuracy"].cpu().tolist()}')
+    log(f'\tPrecision: {metrics["precision"].cpu().tolist()}')
+    log(f'\tRecall: {metrics["recall"].cpu().tolist()}')
+    log(f'\tF1 Score: {metrics["f1"].cpu().tolist()}')
+    log(f'\tTuned thresholds: {[round(t, 3) for t in thresholds.tolist()]}')
+    log(f'\tTest F1 Score at tuned thresholds: {tuned_metrics["f1"].cpu().tolist()}')
+    log()
+
+    is_best = test_loss < best_loss
 
     if best_loss - test_loss < min_improvement:
         epochs_without_improvement += 1
     else:
         epochs_without_improvement = 0
 
-    if epochs_without_improvement == stopping_patience:
-        print(f'\nEarly stopping at epoch {epoch}')
+    best_loss = min(best_loss, test_loss)
+    stopping = epochs_without_improvement == stopping_patience
+
+    if is_main_process and (is_best or stopping or epoch % args.checkpoint_every == 0 or epoch == epochs):
+        checkpoint_writer.save({
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
+            'rng': get_rng_state(),
+            'train_losses': train_losses,
+            'test_losses': test_losses,
+            'best_loss': best_loss,
+            'epochs_without_improvement': epochs_without_improvement,
+            'classes': train_data.classes,
+            'thresholds': thresholds.tolist()
+        }, is_best=is_best)
+
+    if stopping:
+        log(f'\nEarly stopping at epoch {epoch}')
         break
 
-    best_loss = min(best_loss, test_loss)
+trace_capture.stop() # Runs shorter than --profile steps still get their trace
 
+if args.distributed:
+    dist.destroy_process_group()
+
+if not is_main_process:
+    exit()
+
+checkpoint_writer.close()
+log(f'Best test loss {best_loss} saved in {args.checkpoint_dir/BEST}')
 
 plt.plot(train_losses, label='train_loss')
 plt.plot(test_losses, label='test_loss')
 plt.legend()
-plt.show()
 
-save = input('Do you want to save this model? [y/n] ')
+if args.non_interactive:
+    plot_path = args.checkpoint_dir/'losses.png'
+    plt.savefig(plot_path)
+    log(f'Loss curves saved to {plot_path}')
+else:
+    plt.show()
 
-if save.lower() == 'n' or save.lower() == 'no':
+if args.model_name is not None:
+    model_name = args.model_name
+elif args.non_interactive:
     exit()
+else:
+    save = input('Do you want to save this model? [y/n] ')
+
+    if save.lower() == 'n' or save.lower() == 'no':
+        exit()
 
-model_name = input('Enter model name: ')
+    model_name = input('Enter model name: ')
 
 model_path = Path('models')
 model_path.mkdir(parents=True, exist_ok=True)
 
 model_save_path = model_path/model_name
 
-torch.save(model.state_dict(), model_save_path)
+# The manifest goes first, so a server reloading the replaced weights reads
+#   the matching one. Both are renamed into place, never rewritten
+meta_path = save_meta(model_save_path, ModelMeta(train_data.classes, thresholds.tolist(), hidden_count, image_size))
+replace_file(model_save_path, lambda tmp_path: torch.save(model.state_dict(), tmp_path))
+log(f'Model saved to {model_save_path} with its manifest in {meta_path}')